@@ -0,0 +1,109 @@
+import itertools
+import json
+import logging
+import socket
+
+from serialization import infos_from_list
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteEngine:
+    """Stands in for a SimpleEngine, with the id and option names of the analysis server's engines"""
+
+    def __init__(self, engine_id, options):
+        self.id = engine_id
+        self.options = options
+
+
+class AnalysisClient:
+    """Searches on a shared analysis server. Used by the bot in place of an EngineSupervisor,
+    for fixed depth searches only: there is no analysis() to stream from, so the bot does not stream with it"""
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.socket = None
+        self.file = None
+        self.request_ids = itertools.count()
+
+        self.requests = 0
+        self.reconnects = 0
+
+        hello = self.request({'type': 'hello'})
+        self.engine = RemoteEngine(hello['engine_id'], hello['options'])
+        # values the server's engines were started with, which configure() cannot change
+        self.server_options = hello.get('configured', {})
+        self.last_engine = self.engine
+        logger.info('Using analysis server %s running %s', socket_path, self.engine.id.get('name', 'an engine'))
+
+    @property
+    def engine_id(self):
+        return self.engine.id
+
+    @property
+    def engine_options(self):
+        return self.engine.options
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(self.socket_path)
+        self.file = self.socket.makefile('rwb')
+
+    def close(self):
+        if self.socket is not None:
+            self.file.close()
+            self.socket.close()
+        self.socket = None
+        self.file = None
+
+    def request(self, message):
+        """Send a request and wait for its response, reconnecting once if the connection was lost"""
+        for attempt in range(2):
+            try:
+                if self.socket is None:
+                    self.connect()
+                message = dict(message, id=next(self.request_ids))
+                self.file.write((json.dumps(message) + '\n').encode())
+                self.file.flush()
+                while True:
+                    line = self.file.readline()
+                    if not line:
+                        raise ConnectionError('Analysis server closed the connection')
+                    response = json.loads(line)
+                    if response.get('id') == message['id']:
+                        break  # earlier responses are for requests that timed out
+            except OSError as e:
+                self.close()
+                if attempt > 0:
+                    raise
+                logger.warning('Lost connection to analysis server: %s. Reconnecting', e)
+                self.reconnects += 1
+                continue
+
+            if 'error' in response:
+                raise Exception('Analysis server error: {0}'.format(response['error']))
+            return response
+
+    def analyse(self, board, limit, multipv=None):
+        """Same results as SimpleEngine.analyse, for depth limits"""
+        if limit.depth is None:
+            raise ValueError('The analysis server only searches to a fixed depth')
+        self.requests += 1
+        response = self.request({'type': 'analyse', 'fen': board.fen(), 'depth': limit.depth,
+                                 'multipv': multipv if multipv is not None else 1})
+        infos = infos_from_list(response['infos'], board.turn)
+        return infos if multipv is not None else infos[0]
+
+    def configure(self, options):
+        logger.warning('Engine options are set by the analysis server; ignoring %s', options)
+
+    def server_stats(self):
+        return self.request({'type': 'stats'})
+
+    def stats(self):
+        return {'requests': self.requests, 'reconnects': self.reconnects, 'connected': self.socket is not None}
+
+    def quit(self):
+        self.close()
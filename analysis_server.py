@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+from configparser import ConfigParser
+
+import chess
+import chess.engine
+import chess.polyglot
+
+from engine_config import cache_engine_name, engine_path, pool_setting, requested_options
+from engine_pool import EnginePool
+from evaluation_cache import EvaluationCache
+from logging_setup import setup_logging_from_config
+from position_store import PositionStore
+from serialization import infos_to_list
+
+logger = logging.getLogger(__name__)
+
+
+class Search:
+    def __init__(self, key, board, depth, multipv):
+        self.key = key  # (zobrist hash, depth, multipv)
+        self.board = board
+        self.depth = depth
+        self.multipv = multipv
+        self.future = asyncio.get_running_loop().create_future()
+        self.clients = set()  # ids of the clients waiting on this search
+
+
+class AnalysisServer:
+    """Serves analysis requests from bot processes on a Unix socket, with one engine pool and cache shared by all.
+    Requests are newline-delimited JSON; identical concurrent requests are answered by a single search,
+    and clients take turns at the engines so a busy client cannot starve the others."""
+
+    def __init__(self, pool, cache, socket_path):
+        self.pool = pool
+        self.cache = cache
+        self.socket_path = socket_path
+
+        self.searches = {}  # (zobrist hash, depth, multipv) -> Search, queued or running
+        # client id -> searches it queued and which have not started yet, in round-robin order
+        self.queues = collections.OrderedDict()
+        self.client_ids = itertools.count()
+        self.work_available = None
+        self.slots = None
+
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.searched = 0
+
+    async def serve(self):
+        self.work_available = asyncio.Event()
+        # no more searches are started than the pool has engines, so the round robin decides who goes next
+        self.slots = asyncio.Semaphore(self.pool.worker_count)
+        dispatcher = asyncio.create_task(self.dispatch())
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        logger.info('Serving analysis on %s', self.socket_path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            dispatcher.cancel()
+
+    async def handle_client(self, reader, writer):
+        client = next(self.client_ids)
+        self.queues[client] = collections.deque()
+        logger.info('Client %d connected', client)
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self.respond(client, line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.disconnect(client)
+            writer.close()
+            logger.info('Client %d disconnected', client)
+
+    async def respond(self, client, line, writer):
+        request = {}
+        try:
+            request = json.loads(line)
+            response = await self.handle_request(client, request)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('Exception handling request from client %d: %s', client, e)
+            response = {'error': str(e)}
+        response['id'] = request.get('id')
+        writer.write((json.dumps(response) + '\n').encode())
+        await writer.drain()
+
+    async def handle_request(self, client, request):
+        request_type = request.get('type')
+        if request_type == 'analyse':
+            return await self.analyse(client, request['fen'], request['depth'], request['multipv'])
+        if request_type == 'hello':
+            return {'engine_id': self.pool.engine_id, 'options': list(self.pool.engine_options),
+                    'configured': self.pool.options}
+        if request_type == 'stats':
+            return self.stats()
+        raise ValueError(f'Unknown request type {request_type}')
+
+    async def analyse(self, client, fen, depth, multipv):
+        self.requests += 1
+        board = chess.Board(fen)
+        key = chess.polyglot.zobrist_hash(board)
+
+        entry = self.cache.get(key, depth, multipv, self.cache_name())
+        if entry is None:
+            search = self.searches.get((key, depth, multipv))
+            if search is None:
+                search = self.searches[(key, depth, multipv)] = Search((key, depth, multipv), board, depth, multipv)
+                self.queues[client].append(search)
+                self.work_available.set()
+            else:
+                self.coalesced += 1
+            search.clients.add(client)
+            # other clients may still be waiting on the search if this one disconnects
+            entry = await asyncio.shield(search.future)
+        else:
+            self.cache_hits += 1
+        return {'infos': infos_to_list(entry.infos[:multipv]), 'engine': entry.engine_name}
+
+    async def next_search(self):
+        while True:
+            for client in list(self.queues):
+                queue = self.queues[client]
+                self.queues.move_to_end(client)
+                if queue:
+                    return queue.popleft()
+            self.work_available.clear()
+            await self.work_available.wait()
+
+    async def dispatch(self):
+        while True:
+            await self.slots.acquire()
+            search = await self.next_search()
+            asyncio.create_task(self.run_search(search))
+
+    async def run_search(self, search):
+        try:
+            self.searched += 1
+            infos = await asyncio.wrap_future(
+                self.pool.submit(search.board, chess.engine.Limit(depth=search.depth), multipv=search.multipv))
+            if not isinstance(infos, list):
+                infos = [infos]
+            entry = self.cache.put(search.key[0], infos, search.depth, search.multipv, self.cache_name())
+            search.future.set_result(entry)
+        except Exception as e:
+            search.future.set_exception(e)
+            search.future.exception()  # nobody may be waiting any more; don't warn about it
+        finally:
+            del self.searches[search.key]
+            self.slots.release()
+
+    def disconnect(self, client):
+        for search in self.searches.values():
+            search.clients.discard(client)
+        for search in self.queues.pop(client):
+            if search.clients:
+                self.queues[next(iter(search.clients))].append(search)  # hand it to a client still waiting
+            else:
+                del self.searches[search.key]
+                search.future.cancel()
+
+    def cache_name(self):
+        # the position store may be shared with bots playing at other strengths
+        return cache_engine_name(self.pool.engine_id.get('name'), self.pool.options, self.pool.engine_options)
+
+    def stats(self):
+        return {'clients': len(self.queues),
+                'requests': self.requests,
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'searches': self.searched,
+                'queued': sum(len(queue) for queue in self.queues.values()),
+                'cache': self.cache.stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share engines and a position cache between bot processes')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--socket', help='defaults to [analysis_server] socket')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    log_listener = setup_logging_from_config(config)
+    socket_path = args.socket if args.socket is not None else config['analysis_server']['socket']
+
+    engine_name = config['engine']['name']
+    # filtered against the engines' options once they have started
+    pool = EnginePool(engine_path(config, engine_name),
+                      workers=pool_setting(config, engine_name, 'workers'),
+                      threads=pool_setting(config, engine_name, 'threads'),
+                      hash_size=pool_setting(config, engine_name, 'hash'),
+                      options=requested_options(config),
+                      protocol=config['engine']['protocol'],
+                      timeout=config['engine_pool'].getfloat('timeout'))
+    store = None
+    if config.getboolean('position_store', 'enabled', fallback=False):
+        store = PositionStore.from_config(config)
+    cache = EvaluationCache(config['engine'].getint('cache_size', fallback=50000), store=store)
+    server = AnalysisServer(pool, cache, socket_path)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Server stats: %s', server.stats())
+        pool.quit()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
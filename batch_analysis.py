@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+from configparser import ConfigParser
+
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+
+from engine_config import engine_path, pool_setting, requested_options
+from evaluation_cache import EvaluationCache
+from logging_setup import setup_logging_from_config
+from serialization import infos_to_list
+
+logger = logging.getLogger(__name__)
+
+# engine of the current worker process, and what it was started with so it can be started again
+worker_engine = None
+worker_args = None
+# why the worker's engine could not be started, reported by its first task
+worker_error = None
+
+
+class WorkerStartError(Exception):
+    pass
+
+
+def open_engine(path, protocol, options):
+    if protocol == 'xboard':
+        engine = chess.engine.SimpleEngine.popen_xboard(path)
+    else:
+        engine = chess.engine.SimpleEngine.popen_uci(path)
+    engine.configure({name: value for name, value in options.items() if name in engine.options})
+    return engine
+
+
+def init_worker(path, protocol, options):
+    global worker_engine, worker_args, worker_error
+    worker_args = (path, protocol, options)
+    try:
+        worker_engine = open_engine(*worker_args)
+    except Exception as e:
+        # raising here would have the pool start a replacement worker, which fails the same way, forever
+        worker_error = '{0}: {1}'.format(path, e)
+
+
+def analyse_position(fen, depth, multipv):
+    global worker_engine
+    if worker_engine is None:
+        raise WorkerStartError(worker_error)
+    board = chess.Board(fen)
+    try:
+        infos = worker_engine.analyse(board, chess.engine.Limit(depth=depth), multipv=multipv)
+    except chess.engine.EngineTerminatedError:
+        # restarted once, so a crash costs this worker one position rather than the rest of the run
+        worker_engine = open_engine(*worker_args)
+        infos = worker_engine.analyse(board, chess.engine.Limit(depth=depth), multipv=multipv)
+    return infos_to_list(infos), worker_engine.id.get('name')
+
+
+class BatchAnalysis:
+    def __init__(self, config, output_path, workers, depth, multipv, cache_size=1000000, max_in_flight=None):
+        self.config = config
+        self.output_path = output_path
+        self.workers = workers
+        self.depth = depth
+        self.multipv = multipv
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 4 * workers
+
+        # zobrist hash -> serialised infos, shared by every game that reaches the position
+        self.results = EvaluationCache(cache_size)
+        # zobrist hash -> records waiting on a search that is in flight
+        self.pending = {}
+        self.completed = set()  # (game, ply) pairs already in the output
+        self.finished = queue.Queue()
+
+        self.positions = 0
+        self.searches = 0
+        self.reused = 0
+
+    def load_checkpoint(self):
+        """Resume from an earlier run: every record in the output is done and its evaluation can be reused"""
+        if not os.path.exists(self.output_path):
+            return
+        self.truncate_partial_record()
+        with open(self.output_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping unreadable record in %s', self.output_path)
+                    continue
+                self.completed.add((record['game'], record['ply']))
+                self.results.put(int(record['zobrist'], 16), record['infos'], record['depth'], record['multipv'],
+                                 record['engine'])
+        logger.info('Resuming with %d evaluated moves', len(self.completed))
+
+    def truncate_partial_record(self):
+        # an interrupted run may have stopped part way through a line, which new records must not be appended to
+        with open(self.output_path, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                f.truncate(content.rfind(b'\n') + 1)
+
+    def read_positions(self, pgn_paths):
+        game_index = 0
+        for path in pgn_paths:
+            with open(path) as pgn:
+                while True:
+                    game = chess.pgn.read_game(pgn)
+                    if game is None:
+                        break
+                    board = game.board()
+                    for ply, move in enumerate(game.mainline_moves()):
+                        if (game_index, ply) not in self.completed:
+                            yield {'game': game_index,
+                                   'ply': ply,
+                                   'move': board.san(move),
+                                   'fen': board.fen(),
+                                   'zobrist': chess.polyglot.zobrist_hash(board)}
+                        board.push(move)
+                    game_index += 1
+
+    def write(self, output, record, entry):
+        record = dict(record)
+        record['zobrist'] = format(record['zobrist'], '016x')
+        record['depth'] = entry.depth
+        record['multipv'] = entry.multipv
+        record['engine'] = entry.engine_name
+        record['infos'] = entry.infos[:self.multipv]
+        output.write(json.dumps(record) + '\n')
+        self.positions += 1
+
+    def drain(self, output, block):
+        while True:
+            try:
+                key, result = self.finished.get(block=block)
+            except queue.Empty:
+                return
+            block = False
+            waiting = self.pending.pop(key)
+            if isinstance(result, WorkerStartError):
+                raise Exception('Could not start the engine of a worker: {0}'.format(result))
+            if isinstance(result, Exception):
+                logger.error('Exception analysing %s: %s', waiting[0]['fen'], result)
+                continue  # left out of the output, so a resumed run tries again
+            infos, engine_name = result
+            entry = self.results.put(key, infos, self.depth, self.multipv, engine_name)
+            for record in waiting:
+                self.write(output, record, entry)
+            output.flush()
+
+    def run(self, pgn_paths):
+        self.load_checkpoint()
+
+        path = engine_path(self.config, self.config['engine']['name'])
+        # filtered against each worker's engine options once it has started
+        options = requested_options(self.config)
+        options['Threads'] = pool_setting(self.config, self.config['engine']['name'], 'threads')
+        options['Hash'] = pool_setting(self.config, self.config['engine']['name'], 'hash')
+
+        with multiprocessing.Pool(self.workers, initializer=init_worker,
+                                  initargs=(path, self.config['engine']['protocol'], options)) as pool, \
+                open(self.output_path, 'a') as output:
+            for record in self.read_positions(pgn_paths):
+                key = record['zobrist']
+                entry = self.results.get(key, self.depth, self.multipv)
+                if entry is not None:
+                    self.reused += 1
+                    self.write(output, record, entry)
+                elif key in self.pending:
+                    self.reused += 1
+                    self.pending[key].append(record)
+                else:
+                    while len(self.pending) >= self.max_in_flight:
+                        self.drain(output, block=True)
+                    self.pending[key] = [record]
+                    self.searches += 1
+                    pool.apply_async(analyse_position, (record['fen'], self.depth, self.multipv),
+                                     callback=lambda result, key=key: self.finished.put((key, result)),
+                                     error_callback=lambda error, key=key: self.finished.put((key, error)))
+                self.drain(output, block=False)
+
+            while self.pending:
+                self.drain(output, block=True)
+
+        logger.info('Wrote %d moves from %d searches (%d reused)', self.positions, self.searches, self.reused)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyse PGN games headlessly and write evaluations to JSONL')
+    parser.add_argument('pgn', nargs='+', help='PGN files to analyse')
+    parser.add_argument('--output', '-o', required=True, help='JSONL file; an existing file is resumed')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--depth', type=int, help='defaults to [engine] search_depth')
+    parser.add_argument('--multipv', type=int, help='defaults to [engine] multipv_count, or 1 without use_multipv')
+    parser.add_argument('--cache-size', type=int, default=1000000, help='evaluations kept for reuse across games')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    log_listener = setup_logging_from_config(config)
+
+    depth = args.depth if args.depth is not None else config['engine'].getint('search_depth')
+    multipv = args.multipv
+    if multipv is None:
+        multipv = config['engine'].getint('multipv_count') if config['engine'].getboolean('use_multipv') else 1
+
+    try:
+        BatchAnalysis(config, args.output, args.workers, depth, multipv, args.cache_size).run(args.pgn)
+    finally:
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
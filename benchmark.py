@@ -0,0 +1,204 @@
+import argparse
+import json
+import time
+
+import chess.pgn
+
+from bot import Bot
+
+STAGES = ['scrape', 'make_board', 'engine_eval', 'display_moves', 'poll']
+
+
+class FakeWebDriver:
+    """Stands in for the Firefox WebDriver, serving a move list that the benchmark advances one ply at a time"""
+    w3c = True  # read by ActionChains
+
+    def __init__(self, latency=0.0, board_rect=(0, 0, 800), orientation='white'):
+        self.latency = latency
+        self.board_present = True
+        self.board_rect = board_rect
+        self.geometry = 0  # counts board rect changes, like the page-side geometry counter
+        self.orientation = orientation
+        self.interface = None  # SeleniumChess instance whose scripts this driver answers
+
+        self.moves = []
+        self.log_id = 'benchmark'
+        self.log_seq = 0
+        self.log_events = {}
+
+        self.script_calls = 0
+        self.async_script_calls = 0
+
+    def set_page_moves(self, moves):
+        """Replace the page's move list, recording the change like the page-side move log does"""
+        ply = 0
+        while ply < len(moves) and ply < len(self.moves) and moves[ply] == self.moves[ply]:
+            ply += 1
+        if ply == len(moves) and ply == len(self.moves):
+            return
+        self.log_seq += 1
+        self.log_events[self.log_seq] = {'ply': ply, 'moves': list(moves[ply:])}
+        self.moves = list(moves)
+
+    def set_board_rect(self, board_rect):
+        if board_rect != self.board_rect:
+            self.board_rect = board_rect
+            self.geometry += 1
+
+    def move_log_since(self, log_id, seq):
+        if log_id != self.log_id or seq > self.log_seq:
+            return {'id': self.log_id, 'seq': self.log_seq, 'reset': True, 'moves': list(self.moves)}
+        return {'id': self.log_id, 'seq': self.log_seq, 'reset': False,
+                'events': [self.log_events[i] for i in range(seq + 1, self.log_seq + 1)]}
+
+    def round_trip(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def set_script_timeout(self, timeout):
+        self.round_trip()
+
+    def execute_script(self, script, *args):
+        self.round_trip()
+        self.script_calls += 1
+        if self.interface is not None and script == self.interface.snapshot_script:
+            if not self.board_present:
+                return {'boardPresent': False}
+            result = {'boardPresent': True, 'orientation': self.orientation, 'geometry': self.geometry,
+                      'moveLog': self.move_log_since(args[1], args[2])}
+            if args[1] != self.log_id or args[3] != self.geometry:
+                result['x'], result['y'], result['width'] = self.board_rect
+            return result
+        return None  # canvas scripts have no result
+
+    def execute_async_script(self, script, *args):
+        self.round_trip()
+        self.async_script_calls += 1
+        return self.changed_boards(args[0])
+
+    def changed_boards(self, versions):
+        # answers a wait on the versions of the page's boards with the ones that changed
+        return [index for index, log_id, seq in versions if log_id != self.log_id or seq != self.log_seq]
+
+    def round_trips(self):
+        return self.script_calls + self.async_script_calls
+
+
+def read_games(paths, max_games=None):
+    for path in paths:
+        with open(path) as pgn:
+            while max_games is None or max_games > 0:
+                game = chess.pgn.read_game(pgn)
+                if game is None:
+                    break
+                board = game.board()
+                san_moves = []
+                for move in game.mainline_moves():
+                    san_moves.append(board.san(move))
+                    board.push(move)
+                yield san_moves
+                if max_games is not None:
+                    max_games -= 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Benchmark:
+    def __init__(self, config_file, latency, idle_polls, driver=None):
+        self.idle_polls = idle_polls
+        self.timings = {stage: [] for stage in STAGES}
+        self.round_trips_per_poll = []
+
+        self.driver = driver if driver is not None else FakeWebDriver(latency=latency)
+        self.bot = Bot(driver=self.driver, config_file=config_file)
+        self.driver.interface = self.bot.interface
+
+        self.bot.interface.take_snapshot = self.timed('scrape', self.bot.interface.take_snapshot)
+        self.bot.make_board = self.timed('make_board', self.bot.make_board)
+        self.bot.evaluate = self.timed('engine_eval', self.bot.evaluate)
+        self.bot.display_moves = self.timed('display_moves', self.bot.display_moves)
+        self.bot.poll = self.timed('poll', self.bot.poll)
+
+    def timed(self, stage, method):
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.timings[stage].append(time.perf_counter() - start_time)
+        return wrapper
+
+    def step(self):
+        """One turn of the bot's main loop, counting the round trips of its wait for moves as well as of the poll"""
+        round_trips = self.driver.round_trips()
+        self.bot.step()
+        self.round_trips_per_poll.append(self.driver.round_trips() - round_trips)
+
+    def play(self, san_moves):
+        self.driver.set_page_moves([])
+        self.step()
+        for ply in range(1, len(san_moves) + 1):
+            self.driver.set_page_moves(san_moves[:ply])
+            self.step()
+            for _ in range(self.idle_polls):
+                self.step()
+
+    def report(self):
+        report = {}
+        for stage, values in self.timings.items():
+            report[stage] = {'count': len(values),
+                             'p50_ms': 1000 * percentile(values, 0.50),
+                             'p95_ms': 1000 * percentile(values, 0.95),
+                             'p99_ms': 1000 * percentile(values, 0.99)}
+        polls = len(self.round_trips_per_poll)
+        report['round_trips'] = {'polls': polls,
+                                 'mean_per_poll': sum(self.round_trips_per_poll) / polls if polls else 0.0,
+                                 'max_per_poll': max(self.round_trips_per_poll, default=0)}
+        report['eval_cache'] = self.bot.eval_cache.stats()
+        return report
+
+
+def print_report(report):
+    print('{0:<15}{1:>8}{2:>12}{3:>12}{4:>12}'.format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for stage in STAGES:
+        timing = report[stage]
+        print('{0:<15}{1:>8}{2:>12.3f}{3:>12.3f}{4:>12.3f}'.format(stage, timing['count'], timing['p50_ms'],
+                                                                    timing['p95_ms'], timing['p99_ms']))
+    round_trips = report['round_trips']
+    print('Round trips per poll: mean {0:.2f}, max {1} over {2} polls'.format(round_trips['mean_per_poll'],
+                                                                             round_trips['max_per_poll'],
+                                                                             round_trips['polls']))
+    print('Evaluation cache: {0}'.format(report['eval_cache']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay PGN games through the bot against a fake WebDriver')
+    parser.add_argument('pgn', nargs='+', help='PGN files to replay')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--games', type=int, default=None, help='maximum number of games to replay')
+    parser.add_argument('--latency', type=float, default=0.002, help='simulated seconds per WebDriver round trip')
+    parser.add_argument('--idle-polls', type=int, default=2, help='extra polls of each position after it appears')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.config, args.latency, args.idle_polls)
+    try:
+        for san_moves in read_games(args.pgn, args.games):
+            benchmark.play(san_moves)
+    finally:
+        benchmark.bot.engine_manager.quit()
+
+    report = benchmark.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import chess
+
+from constants import Side
+from vector_2d import Vector2D
+
+
+class BoardGeometry:
+    """Page coordinates of every square for both orientations, rebuilt only when the board rect changes.
+    The positions handed out are shared between calls and must not be modified."""
+
+    def __init__(self):
+        # (move log id, counter) of the page-side geometry the tables were built from
+        self.version = None
+        self.board_pos = None
+        self.board_dim = None
+        self.piece_dim = None
+        self.square_dims = None
+        self.corners = {}  # Side -> top left corner of each square, indexed by chess square
+        self.centres = {}  # Side -> centre of each square, where arrows start and end
+        self.label_anchors = {}  # (Side, from square, to square) -> midpoint of the move, filled as needed
+
+    def update(self, version, x, y, width):
+        self.version = version
+        if self.board_pos is not None and (self.board_pos.x, self.board_pos.y, self.board_dim) == (x, y, width):
+            return
+        self.board_pos = Vector2D(x, y)
+        self.board_dim = width  # Board is square; either dimension will do
+        self.piece_dim = self.board_dim // 8
+        self.square_dims = Vector2D(self.piece_dim, self.piece_dim)
+        center_offset = self.piece_dim // 2
+
+        for side in (Side.WHITE, Side.BLACK):
+            corners = []
+            for square in chess.SQUARES:
+                file = chess.square_file(square)
+                rank = chess.square_rank(square) + 1
+                if side == Side.WHITE:
+                    corner = Vector2D(self.piece_dim * file, self.board_dim - self.piece_dim * rank)
+                else:
+                    corner = Vector2D(self.piece_dim * (7 - file), self.board_dim - self.piece_dim * (9 - rank))
+                corners.append(Vector2D(corner.x + x, corner.y + y))
+            self.corners[side] = corners
+            self.centres[side] = [Vector2D(corner.x + center_offset, corner.y + center_offset) for corner in corners]
+        self.label_anchors = {}
+
+    def corner(self, square, bottom_color):
+        return self.corners[bottom_color][square]
+
+    def centre(self, square, bottom_color):
+        return self.centres[bottom_color][square]
+
+    def label_anchor(self, move, bottom_color):
+        key = (bottom_color, move.from_square, move.to_square)
+        anchor = self.label_anchors.get(key)
+        if anchor is None:
+            first_pos = self.centre(move.from_square, bottom_color)
+            second_pos = self.centre(move.to_square, bottom_color)
+            anchor = self.label_anchors[key] = Vector2D((first_pos.x + second_pos.x) / 2,
+                                                        (first_pos.y + second_pos.y) / 2)
+        return anchor
@@ -0,0 +1,142 @@
+import logging
+import time
+
+from selenium.common.exceptions import StaleElementReferenceException
+
+from bot import Bot
+
+logger = logging.getLogger(__name__)
+
+# engine pool priorities; searches for a board whose position just changed run before re-evaluations of idle boards
+CHANGED_PRIORITY = 0
+IDLE_PRIORITY = 2
+
+
+class ScheduledBoard:
+    def __init__(self, bot, handle, interval):
+        self.bot = bot
+        self.handle = handle
+        self.interval = interval
+        self.next_poll_time = 0.0
+
+
+class BoardScheduler:
+    """Watches every chess board in every tab of one browser, with one set of engines shared between the boards"""
+
+    def __init__(self, config_file='config.ini', driver=None):
+        # the first board of the current tab, which owns the browser, engines and caches
+        self.bot = Bot(driver=driver, config_file=config_file)
+        self.driver = self.bot.driver
+        self.metrics = self.bot.metrics
+
+        config = self.bot.config['boards']
+        self.min_interval = config.getfloat('min_interval')
+        self.max_interval = config.getfloat('max_interval')
+        self.discover_interval = config.getfloat('discover_interval')
+        if self.bot.streaming is not None:
+            logger.warning('Streaming analysis only runs on the first board')
+        if self.bot.engine_pool is None:
+            logger.warning('Without [engine_pool] enabled, boards are searched one at a time')
+
+        self.current_handle = self.driver.current_window_handle
+        self.boards = {(self.current_handle, 0): ScheduledBoard(self.bot, self.current_handle, self.min_interval)}
+        self.last_discovery = None
+
+        self.metrics.add_collector(lambda: {'boards': len(self.boards)})
+
+    def switch_to(self, handle):
+        if handle != self.current_handle:
+            self.driver.switch_to.window(handle)
+            self.current_handle = handle
+
+    def discover(self):
+        """Start tracking boards in new tabs or newly added to a page, and stop tracking ones that have gone"""
+        handles = self.driver.window_handles
+        if self.current_handle not in handles:
+            self.current_handle = None  # the tab was closed; switch before running any script
+        for key in [key for key in self.boards if key[0] not in handles]:
+            self.drop(key)
+
+        for handle in handles:
+            self.switch_to(handle)
+            count = self.bot.interface.count_boards()
+            for key in [key for key in self.boards if key[0] == handle and key[1] >= count]:
+                self.drop(key)
+            for index in range(count):
+                if (handle, index) not in self.boards:
+                    logger.info('Watching board %d in window %s', index, handle)
+                    bot = Bot(board_index=index, parent=self.bot)
+                    self.boards[(handle, index)] = ScheduledBoard(bot, handle, self.min_interval)
+        self.last_discovery = time.monotonic()
+
+    def drop(self, key):
+        logger.info('Stopped watching board %d in window %s', key[1], key[0])
+        bot = self.boards.pop(key).bot
+        if bot.pending_eval is not None:
+            bot.pending_eval.cancel()
+        if bot.speculator is not None:
+            bot.speculator.cancel()
+
+    def wait_for_changes(self):
+        """Wait for a move on any board until the next board is due. Returns the keys of boards that changed"""
+        if not self.boards:
+            time.sleep(self.min_interval)
+            return set()
+        timeout = max(0.0, min(board.next_poll_time for board in self.boards.values()) - time.monotonic())
+        timeout = min(timeout, self.discover_interval)
+        handles = {board.handle for board in self.boards.values()}
+
+        changed = set()
+        for handle in handles:
+            interfaces = [board.bot.interface for board in self.boards.values() if board.handle == handle]
+            self.switch_to(handle)
+            # a single tab can block in the browser; several tabs are checked in turn without blocking
+            indices = interfaces[0].wait_for_changes(interfaces, timeout if len(handles) == 1 else 0)
+            changed.update((handle, index) for index in indices or ())
+        if not changed and len(handles) > 1:
+            time.sleep(min(timeout, self.min_interval))
+        return changed
+
+    def poll_board(self, key, changed):
+        board = self.boards[key]
+        bot = board.bot
+        seq = bot.interface.move_log_seq
+        bot.eval_priority = CHANGED_PRIORITY if changed else IDLE_PRIORITY
+        # a failure on one board is kept to that board, which is still rescheduled below
+        try:
+            self.switch_to(board.handle)
+            with self.metrics.span('poll'):
+                bot.poll()
+        except StaleElementReferenceException:
+            self.metrics.increment('stale_element_retries')
+            logger.info('Stale elements on board %d. Retrying...', bot.board_index)
+        except Exception:
+            self.metrics.increment('board_poll_exceptions')
+            logger.exception('Exception polling board %d', bot.board_index)
+
+        if bot.interface.move_log_seq != seq:
+            board.interval = self.min_interval
+        elif bot.pending_eval is not None:
+            board.interval = self.min_interval  # pick up the search result as soon as it is ready
+        else:
+            board.interval = min(board.interval * 2, self.max_interval)
+        board.next_poll_time = time.monotonic() + board.interval
+
+    def run(self):
+        while True:
+            try:
+                if self.last_discovery is None or time.monotonic() - self.last_discovery >= self.discover_interval:
+                    self.discover()
+                changed = self.wait_for_changes()
+
+                now = time.monotonic()
+                due = sorted((key for key, board in self.boards.items()
+                              if key not in changed and board.next_poll_time <= now),
+                             key=lambda key: self.boards[key].next_poll_time)
+                # boards whose position just changed are polled, and so get engine time, first
+                for key in sorted(changed) + due:
+                    if key in self.boards:
+                        self.poll_board(key, key in changed)
+            except Exception:
+                self.metrics.increment('main_loop_exceptions')
+                logger.exception('Scheduler exception')
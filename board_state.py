@@ -0,0 +1,50 @@
+import chess
+import chess.polyglot
+
+from constants import START_POS_FEN
+from move_log import MoveLog
+
+
+class BoardState:
+    SAN_MEMO_LIMIT = 100000
+
+    def __init__(self, fen=START_POS_FEN):
+        self.start_fen = fen
+        self.board = chess.Board(fen)
+        self.played = MoveLog()  # SAN of the moves pushed onto board
+        # zobrist hash of the position -> {SAN string: chess.Move}
+        self.san_memo = {}
+
+    def reset(self):
+        self.board = chess.Board(self.start_fen)
+        self.played = MoveLog()
+
+    def parse_san(self, san):
+        if len(self.san_memo) > BoardState.SAN_MEMO_LIMIT:
+            self.san_memo.clear()
+        position_moves = self.san_memo.setdefault(chess.polyglot.zobrist_hash(self.board), {})
+        move = position_moves.get(san)
+        if move is None:
+            move = self.board.parse_san(san)
+            position_moves[san] = move
+        return move
+
+    def update(self, move_log):
+        """Bring the board in line with move_log, pushing only the moves after the common prefix"""
+        prefix_length = self.played.first_difference(move_log)
+        if prefix_length is None:
+            return self.board
+
+        for _ in range(len(self.played) - prefix_length):
+            self.board.pop()
+        self.played.truncate(prefix_length)
+
+        try:
+            for san in move_log.moves[prefix_length:]:
+                self.board.push(self.parse_san(san))
+                self.played.extend((san,))
+        except ValueError:
+            self.reset()
+            raise
+
+        return self.board
@@ -1,18 +1,41 @@
+import concurrent.futures
+import logging
 import time
-import traceback
 from configparser import ConfigParser
 
 import chess
 import chess.engine
+import chess.polyglot
 from selenium import webdriver
 from selenium.common.exceptions import StaleElementReferenceException
 
+from analysis_client import AnalysisClient
+from board_state import BoardState
+from browser_session import BrowserSession
 from constants import *
+from engine_config import EngineInfoCache, cache_engine_name, engine_path, pool_setting, requested_options
+from engine_manager import EngineSupervisor
+from engine_pool import EnginePool
+from ensemble import Ensemble, EnsembleSearch
+from evaluation_cache import EvaluationCache
+from game_review import GameRecord, GameReviewer
+from metrics import Metrics, MetricsExporter
+from opening_book import OpeningBook
+from page_trace import TraceRecorder
+from poll_scheduler import PollScheduler, PollState
+from position_store import PositionStore
 from selenium_chess import SeleniumChess
+from settings import Settings, SettingsWatcher
+from speculation import Speculator
+from streaming_analysis import StreamingAnalysis
+from tablebase import Tablebase
+
+logger = logging.getLogger(__name__)
 
 
 class Bot:
-    def __init__(self):
+    def __init__(self, driver=None, config_file='config.ini', board_index=0, parent=None):
+        self.driver = None
         self.move_list = []
         self.cvs_ctx = []
         self.engine_infos = []
@@ -20,19 +43,170 @@ class Bot:
         self.engine_scores = []
         self.player = None
         self.board = None
-        self.last_move_list = []
+        self.board_state = BoardState()
+        self.last_digest = None  # digest of the move log at the previous poll
         self.position_eval_count = 0
-
-        self.config = ConfigParser()
-        self.config.read('config.ini')
-
-        self.driver = webdriver.Firefox(executable_path=DRIVER_PATH)
-        self.load_engine(self.config['engine']['name'])
-        self.interface = SeleniumChess(self.driver)
-
-        self.setup_browser()
+        self.board_index = board_index
+        # engine pool priority of this board's searches; lower runs first
+        self.eval_priority = 0
+        self.poll_state = PollState.NO_BOARD
+        self.start_time = time.monotonic()
+        self.first_overlay_time = None
+
+        if parent is None:
+            self.config = ConfigParser()
+            self.config.read(config_file)
+            self.settings = Settings.from_config(self.config)
+            self.settings_watcher = None
+            if self.config.getboolean('settings', 'watch_config', fallback=False):
+                self.settings_watcher = SettingsWatcher(config_file, self.settings,
+                                                        self.config['settings'].getfloat('watch_interval'))
+
+            self.metrics = Metrics()
+            self.metrics_exporter = None
+            self.recorder = None
+            # only live sessions are recorded. The benchmark and replay bring their own driver, and replaying with
+            # the config that recorded a trace would otherwise write over the trace being replayed
+            if self.config.get('trace', 'file', fallback='') and driver is None:
+                self.recorder = TraceRecorder(self.config['trace']['file'])
+
+            # the browser launches and logs in while the engines start and the caches load.
+            # An existing driver is used as is, e.g. by the benchmark, without logging in
+            startup = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            browser_started = startup.submit(self.start_browser) if driver is None else None
+            try:
+                self.position_store = None
+                if self.config.getboolean('position_store', 'enabled', fallback=False):
+                    self.position_store = PositionStore.from_config(self.config)
+                self.eval_cache = EvaluationCache(self.config['engine'].getint('cache_size', fallback=50000),
+                                                  store=self.position_store)
+                if self.position_store is not None:
+                    with self.metrics.span('startup_warm_cache'):
+                        loaded = self.eval_cache.warm(self.config['position_store'].getint('warm_entries'))
+                    logger.info('Loaded %d positions from %s', loaded, self.position_store.path)
+                self.book = None
+                if self.config.getboolean('book', 'enabled', fallback=False):
+                    self.book = OpeningBook.from_config(self.config)
+                self.tablebase = None
+                if self.config.getboolean('tablebase', 'enabled', fallback=False):
+                    self.tablebase = Tablebase.from_config(self.config)
+
+                self.streaming = None
+                self.engine_pool = None
+                self.ensemble = None
+                # a server shared by every bot on this host owns the engines and searches for us, so nothing that would
+                # start engines of its own is used alongside it
+                self.remote_engines = self.config.getboolean('analysis_server', 'enabled', fallback=False)
+                if self.remote_engines:
+                    self.engine_manager = AnalysisClient(self.config['analysis_server']['socket'],
+                                                         timeout=self.config['analysis_server'].getfloat('timeout'))
+                else:
+                    info_cache_file = self.config['engine'].get('info_cache', '')
+                    self.engine_manager = EngineSupervisor(
+                        self.config, self.config['engine']['name'],
+                        fallback_name=self.config['engine'].get('fallback', 'stockfish'),
+                        info_cache=EngineInfoCache(info_cache_file) if info_cache_file else None)
+                if self.config.getboolean('engine_pool', 'enabled', fallback=False):
+                    if self.remote_engines:
+                        logger.warning('The engine pool is not used with the analysis server')
+                    else:
+                        self.engine_pool = self.create_engine_pool()
+                if self.config.getboolean('ensemble', 'enabled', fallback=False):
+                    if self.remote_engines:
+                        logger.warning('The ensemble is not used with the analysis server')
+                    else:
+                        self.ensemble = Ensemble.from_config(self.config, self.eval_cache, self.search_limit())
+                if self.config['engine'].getboolean('streaming', fallback=False):
+                    if self.remote_engines:
+                        # the client only answers fixed depth searches, it has no analysis() to stream from
+                        logger.warning('Streaming analysis is not available from the analysis server')
+                    elif self.ensemble is not None:
+                        logger.warning('Streaming analysis is not used with the ensemble')
+                    else:
+                        self.setup_streaming()
+
+                self.driver = driver if driver is not None else browser_started.result()
+            except BaseException:
+                if browser_started is not None:
+                    # a browser left running would outlive the bot, with its geckodriver
+                    browser_started.cancel()
+                    startup.shutdown()
+                    if self.driver is not None:
+                        self.driver.quit()
+                raise
+            finally:
+                startup.shutdown()
+        else:
+            # another board in the same browser, sharing the first board's configuration, engines and caches
+            self.config = parent.config
+            self.settings = parent.settings
+            self.settings_watcher = parent.settings_watcher
+            self.metrics = parent.metrics
+            self.metrics_exporter = None
+            self.recorder = parent.recorder
+            self.position_store = parent.position_store
+            self.eval_cache = parent.eval_cache
+            self.book = parent.book
+            self.tablebase = parent.tablebase
+            self.driver = parent.driver
+            self.engine_manager = parent.engine_manager
+            self.remote_engines = parent.remote_engines
+            self.engine_pool = parent.engine_pool
+            self.ensemble = parent.ensemble
+            self.streaming = None  # a streaming search would hold the shared engine to itself
+        self.pending_eval = None
+        self.pending_key = None
+        self.speculator = None
+        self.reviewer = None
+        self.game_record = None  # evaluations of the game being played, for its review
+        self.game_reviewed = False
+        self.poll_scheduler = PollScheduler.from_config(self.config)
+        self.interface = SeleniumChess(self.driver, board_index, self.recorder)
         self.setup_selenium_chess()
-        self.limit = chess.engine.Limit(depth=self.config['engine'].getint('search_depth'))
+        self.limit = self.search_limit()
+        # engine options the shared engines were last given, updated by whichever board sees a change first
+        self.applied_options = parent.applied_options if parent is not None else self.settings.engine_options()
+        if self.config.getboolean('speculation', 'enabled', fallback=False):
+            shared_pool = parent.speculator.pool if parent is not None and parent.speculator is not None else None
+            self.setup_speculation(shared_pool)
+        if self.config.getboolean('review', 'enabled', fallback=False):
+            self.setup_review(parent.reviewer if parent is not None else None)
+        if parent is not None:
+            return
+
+        self.metrics.add_collector(lambda: {f'engine_{name}': value
+                                            for name, value in self.engine_manager.stats().items()})
+        self.metrics.add_collector(lambda: {f'eval_cache_{name}': value
+                                            for name, value in self.eval_cache.stats().items()})
+        self.metrics.add_collector(lambda: {f'poll_{name}': value
+                                            for name, value in self.poll_scheduler.stats().items()})
+        self.metrics.add_collector(lambda: {'startup_first_overlay_seconds': self.first_overlay_time}
+                                   if self.first_overlay_time is not None else {})
+        if self.settings_watcher is not None:
+            self.metrics.add_collector(lambda: {f'settings_{name}': value
+                                                for name, value in self.settings_watcher.stats().items()})
+        if self.reviewer is not None:
+            self.metrics.add_collector(lambda: {f'review_{name}': value
+                                                for name, value in self.reviewer.stats().items()})
+        if self.recorder is not None:
+            self.metrics.add_collector(lambda: {f'trace_{name}': value
+                                                for name, value in self.recorder.stats().items()})
+        if self.position_store is not None:
+            self.metrics.add_collector(lambda: {f'position_store_{name}': value
+                                                for name, value in self.position_store.stats().items()})
+        if self.tablebase is not None:
+            self.metrics.add_collector(lambda: {f'tablebase_{name}': value
+                                                for name, value in self.tablebase.stats().items()})
+        if self.ensemble is not None:
+            self.metrics.add_collector(lambda: {f'ensemble_{name}': value
+                                                for name, value in self.ensemble.stats().items()})
+        if self.speculator is not None:
+            self.metrics.add_collector(lambda: {f'speculation_{name}': value
+                                                for name, value in self.speculator.stats().items()})
+        if self.config.get('metrics', 'export_file', fallback=''):
+            self.metrics_exporter = MetricsExporter(self.metrics, self.config['metrics']['export_file'],
+                                                    self.config['metrics'].getfloat('export_interval'))
+            self.metrics_exporter.start()
 
     def game_end(move):
         return move == '1-0' or move == '0-1' or move == '1/2-1/2'
@@ -48,190 +222,435 @@ class Bot:
         return len(self.move_list) > 0 and not Bot.game_end(self.move_list[-1]) or len(
             self.move_list) == 0 and self.player == Side.WHITE
 
-    def load_engine(self, engine_name):
-        engine_path = self.config['engine']['directory'] + '/'
-        if os.name == 'nt':  # Windows
-            engine_path += self.config['engine_paths_windows'][engine_name]
-        elif os.name == 'posix':
-            engine_path += self.config['engine_paths_linux'][engine_name]
-        else:
-            raise Exception('Unknown operating system: {0}'.format(os.name))
-
-        engine_protocol = self.config['engine']['protocol']
-        if engine_protocol == 'uci':
-            self.engine = chess.engine.SimpleEngine.popen_uci(engine_path)
-        elif engine_protocol == 'xboard':
-            self.engine = chess.engine.SimpleEngine.popen_xboard(engine_path)
-
-        if 'name' in self.engine.id:
-            print('Loaded engine {0}'.format(self.engine.id['name']))
-        else:
-            print('Engine name is unknown')
-
-        options = {'UCI_LimitStrength': 'true',
-                   'UCI_Elo': self.config['engine'].getint('elo')}
-
-        for option in list(options.keys()):
-            if option in self.engine.options:
-                print(f'{option} is not an option for this engine')
-                del options[option]
-
-        self.engine.configure(options)
-
-        print('Engine options')
-        for option in self.engine.options.values():
-            print(option)
+    def search_limit(self):
+        return chess.engine.Limit(depth=self.settings.search_depth)
+
+    def create_engine_pool(self):
+        engine_name = self.config['engine']['name']
+        path = engine_path(self.config, engine_name)
+        return EnginePool(path,
+                          workers=pool_setting(self.config, engine_name, 'workers'),
+                          threads=pool_setting(self.config, engine_name, 'threads'),
+                          hash_size=pool_setting(self.config, engine_name, 'hash'),
+                          # filtered against the engines' options once they have started
+                          options=requested_options(self.config),
+                          protocol=self.config['engine']['protocol'],
+                          timeout=self.config['engine_pool'].getfloat('timeout'))
+
+    def setup_streaming(self):
+        self.streaming = StreamingAnalysis(self.engine_manager,
+                                           multipv=self.settings.multipv(self.engine_manager.engine_options),
+                                           update_depth=self.config['engine'].getint('stream_update_depth'),
+                                           update_interval=self.config['engine'].getfloat('stream_update_interval'))
+
+    def setup_speculation(self, pool=None):
+        if self.remote_engines:
+            logger.warning('Speculation is not used with the analysis server')
+            return
+        if self.streaming is not None:
+            logger.warning('Speculation is not used while streaming analysis')
+            return
+        if self.ensemble is not None:
+            logger.warning('Speculation is not used with the ensemble')
+            return
+        if pool is None:
+            # speculation needs engines of its own even when the bot searches on the main engine
+            pool = self.engine_pool if self.engine_pool is not None else self.create_engine_pool()
+        self.speculator = Speculator(pool, self.eval_cache, self.limit,
+                                     depth=self.settings.search_depth,
+                                     multipv=self.settings.multipv(pool.engine_options),
+                                     engine_name=self.cache_name(pool.engine_id, pool.engine_options),
+                                     replies=self.config['speculation'].getint('replies'))
+
+    def setup_review(self, reviewer=None):
+        if self.remote_engines:
+            # the server has no low priority queue for the review's searches to wait in
+            logger.warning('Game reviews are not written with the analysis server')
+            return
+        if reviewer is None:
+            # reviews search in the background on whichever pool the bot has, behind its live searches
+            pool = self.engine_pool
+            if pool is None and self.speculator is not None:
+                pool = self.speculator.pool
+            if pool is None:
+                pool = self.create_engine_pool()
+            reviewer = GameReviewer.from_config(self.config, pool)
+        self.reviewer = reviewer
+        self.game_record = GameRecord()
+
+    def start_browser(self):
+        with self.metrics.span('startup_browser'):
+            self.driver = webdriver.Firefox(executable_path=DRIVER_PATH)
+            self.setup_browser()
+        return self.driver
 
     def setup_browser(self):
         self.driver.maximize_window()
-        self.driver.get(START_URL)
-        self.login(self.config['settings']['username'], self.config['settings']['password'])
+        session = BrowserSession(self.driver, self.config['settings'].get('cookie_file', ''))
+        if session.restore():
+            logger.info('Reusing saved login')
+        else:
+            self.driver.get(START_URL)
+            self.login(self.config['settings']['username'], self.config['settings']['password'])
+            session.save()
         self.driver.get(PLAY_CHESS_URL)
 
     def setup_selenium_chess(self):
-        self.cvs_ctx.append(('first_cvs', 'first_ctx'))
+        self.cvs_ctx.append((f'board{self.board_index}_cvs', f'board{self.board_index}_ctx'))
         self.interface.graphics.add_canvas_context(self.cvs_ctx[0][0], self.cvs_ctx[0][1])
 
     def run(self):
         while True:
-            try:
-                # print(f'sleep factor = {self.sleep_factor}')
-                # time.sleep(self.sleep_factor)
-                # self.sleep_factor = min(self.sleep_factor * 2, 10)
-                time.sleep(0.1)
-
-                start_time = time.time()
-
-                if not self.interface.try_set_elements():
-                    print('Cannot find chessboard')
-                    continue
-
-                intermediate_start_time = time.time()
-
-                self.last_move_list = list(self.move_list)
-                self.scrape_move_list()
-
-                # check if position has updated
-                if len(self.move_list) != len(self.last_move_list):
-                    print('Position has changed')
-                    self.position_eval_count = 0
-                elif self.position_eval_count > self.config['engine'].getint('evaluation_tries'):
-                    continue
-
-                print('Time to get moves: {0} seconds'.format(time.time() - intermediate_start_time))
-
-                intermediate_start_time = time.time()
-
-                self.interface.update_variables()
-                self.player = self.interface.find_player_colour()
+            self.step()
 
-                print('Time to update variables: {0} seconds'.format(time.time() - intermediate_start_time))
-
-                print('Player = {0}'.format(self.player))
-                print('Move list = {0}'.format(self.move_list))
-
-                if not self.can_play():
-                    print('Game has ended')
-                    continue
-
-                intermediate_start_time = time.time()
-                self.make_board()  # self.board is None if failed
-                if self.board is None:
-                    self.move_list = []  # rebuild move list if there's an error
-                    continue
-
-                print('Time to make board: {0} seconds'.format(time.time() - intermediate_start_time))
-
-                print(self.board)
-
-                if self.board.turn:
-                    turn = Side.WHITE
-                    turn_name = "WHITE"
-                else:
-                    turn = Side.BLACK
-                    turn_name = "BLACK"
-
-                intermediate_start_time = time.time()
+    def step(self):
+        """Wait for the page to change or the poll interval to pass, then poll once"""
+        try:
+            # a search that is still running should be drawn as soon as it has something new
+            searching = self.pending_eval is not None or self.streaming is not None and self.streaming.is_running()
+            timeout = self.poll_scheduler.timeout(urgent=searching)
+            if self.streaming is not None and self.streaming.is_running():
+                timeout = min(timeout, self.streaming.update_interval)
+            if isinstance(self.pending_eval, EnsembleSearch):
+                # draw what has arrived as soon as the next engine runs out of time
+                time_left = self.pending_eval.time_left()
+                if time_left is not None:
+                    timeout = min(timeout, time_left)
+            # wakes up as soon as the page reports a new move
+            self.poll_scheduler.woke(self.interface.wait_for_moves(timeout))
+
+            with self.metrics.span('poll'):
+                self.poll()
+            self.poll_scheduler.set_state(self.poll_state)
+        except StaleElementReferenceException:
+            self.metrics.increment('stale_element_retries')
+            logger.info('Stale elements. Retrying...')
+        except Exception:
+            self.metrics.increment('main_loop_exceptions')
+            logger.exception('Main loop exception')
+
+    def poll(self):
+        if self.settings_watcher is not None and self.settings_watcher.settings is not self.settings:
+            self.apply_settings(self.settings_watcher.settings)
+
+        with self.metrics.span('snapshot'):
+            snapshot = self.interface.take_snapshot()
+        if not snapshot.board_present:
+            logger.debug('Cannot find chessboard')
+            self.poll_state = PollState.NO_BOARD
+            return
+
+        self.move_list = snapshot.move_list  # the interface's own list, which it updates in place
+
+        # check if position has updated, including corrections that leave the move count the same
+        digest = self.interface.move_log.digest()
+        if digest != self.last_digest:
+            logger.debug('Position has changed')
+            self.last_digest = digest
+            self.position_eval_count = 0
+        elif self.streaming is None and \
+                self.position_eval_count > self.settings.evaluation_tries:
+            return
+
+        self.interface.apply_snapshot(snapshot)
+        self.player = snapshot.player
+
+        logger.debug('Player = %s, move list = %s', self.player, self.move_list)
+
+        if not self.can_play():
+            logger.debug('Game has ended')
+            self.poll_state = PollState.GAME_OVER
+            if self.streaming is not None:
+                self.streaming.stop()
+            if self.reviewer is not None and self.move_list and Bot.game_end(self.move_list[-1]):
+                self.review_game()
+            return
+        self.game_reviewed = False
+
+        with self.metrics.span('make_board'):
+            self.make_board()  # self.board is None if failed
+        if self.board is None:
+            self.poll_state = PollState.NO_BOARD
+            # rebuild move list if there's an error: the page resends the whole list and it is evaluated afresh
+            self.interface.move_log_id = None
+            self.last_digest = None
+            return
+
+        opponent = {Side.WHITE: chess.BLACK, Side.BLACK: chess.WHITE}.get(self.player)
+        self.poll_state = PollState.WAITING_FOR_OPPONENT if self.board.turn == opponent else PollState.OUR_MOVE
+
+        new_position = self.position_eval_count == 0
+        if self.speculator is not None and new_position:
+            self.adopt_speculation()
 
+        try:
+            with self.metrics.span('engine_eval'):
+                if not self.evaluate():
+                    return  # no new lines to draw yet
+        except Exception as e:
+            self.metrics.increment('engine_failures')
+            logger.error('Exception evaluating: %s', e)
+            return
+
+        if self.speculator is not None and new_position:
+            self.speculator.speculate(self.board, self.engine_infos)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            self.log_engine_lines()
+
+        with self.metrics.span('draw'):
+            self.display_moves()
+
+        self.position_eval_count += 1
+
+    def apply_settings(self, settings):
+        """Switch to a reloaded settings snapshot, reconfiguring only the engine options that changed"""
+        self.settings = settings
+        self.limit = self.search_limit()
+        self.position_eval_count = 0  # evaluate the current position again with the new settings
+
+        if self.streaming is not None:
+            # restarted with the new settings at the next evaluation
+            self.streaming.stop()
+            self.streaming.multipv = settings.multipv(self.engine_manager.engine_options)
+        if self.speculator is not None:
+            self.speculator.limit = self.limit
+            self.speculator.depth = settings.search_depth
+            self.speculator.multipv = settings.multipv(self.speculator.pool.engine_options)
+        if self.ensemble is not None:
+            self.ensemble.limit = self.limit
+            self.ensemble.depth = settings.search_depth
+
+        changed = {name: value for name, value in settings.engine_options().items()
+                   if self.applied_options.get(name) != value}
+        if changed:
+            self.applied_options.update(changed)
+            logger.info('Reconfiguring engines: %s', changed)
+            self.engine_manager.configure(changed)
+            pools = [self.engine_pool]
+            if self.speculator is not None and self.speculator.pool is not self.engine_pool:
+                pools.append(self.speculator.pool)  # started for speculation alone
+            for pool in pools:
+                if pool is not None:
+                    pool.configure(changed)
+            if self.ensemble is not None:
+                self.ensemble.configure(changed)
+        if self.speculator is not None:
+            # cached under the new strength from now on, so lines searched at the old one are not reused
+            self.speculator.engine_name = self.cache_name(self.speculator.pool.engine_id,
+                                                          self.speculator.pool.engine_options)
+
+    def cache_name(self, engine_id, available_options):
+        """Name to cache an engine's lines under, at the strength it is currently set to.
+        The analysis server's engines keep the server's own settings whatever this bot's config says"""
+        options = self.engine_manager.server_options if self.remote_engines else self.applied_options
+        return cache_engine_name(engine_id.get('name'), options, available_options)
+
+    def review_game(self):
+        """Hand the evaluations of the game that just ended to the reviewer, once per game"""
+        if self.game_reviewed:
+            return
+        self.game_reviewed = True
+        board = chess.Board(START_POS_FEN)
+        try:
+            for san in self.move_list[:-1]:
+                board.push_san(san)
+        except ValueError as e:
+            logger.warning('Cannot review game: %s', e)
+            return
+        self.reviewer.submit(self.game_record, board, {'result': self.move_list[-1],
+                                                       'player': self.player.name.lower()})
+        self.game_record = GameRecord()
+
+    def log_engine_lines(self):
+        logger.debug('Board:\n%s', self.board)
+        logger.debug('%s is playing', 'WHITE' if self.board.turn else 'BLACK')
+        for i in range(len(self.engine_moves)):
+            output_line = f'Move {i} = {self.engine_moves[i]}, Score = {self.engine_scores[i]}'
+            if self.settings.use_multipv:
                 try:
-                    self.engine_eval()
+                    output_line += f', PV = {self.board.variation_san(self.engine_infos[i]["pv"])}'
                 except Exception as e:
-                    print('Exception evaluating: {0}'.format(e))
-                    continue
-
-                print('Time to evaluate: {0} seconds'.format(time.time() - intermediate_start_time))
-
-                print('{0} is playing'.format(turn_name))
-                for i in range(len(self.engine_moves)):
-                    output_line = f'Move {i} = {self.engine_moves[i]}, Score = {self.engine_scores[i]}'
-                    if self.config['engine'].getboolean('use_multipv'):
-                        try:
-                            output_line += f', PV = {self.board.variation_san(self.engine_infos[i]["pv"])}'
-                        except Exception as e:
-                            print(f'Exception in multi PV output: {e}')
-                    print(output_line)
-
-                intermediate_start_time = time.time()
-
-                self.display_moves()
-
-                print('Time to display: {0} seconds'.format(time.time() - intermediate_start_time))
-
-                self.position_eval_count += 1
-
-                end_time = time.time()
-                print('Time elapsed = {0}s'.format(end_time - start_time))
-
-                time.sleep(1)
-            except StaleElementReferenceException:
-                print('Stale elements. Retrying...')
-            except Exception as exception:
-                print(f'Main loop exception: {exception}')
-                print(traceback.format_exc())
-
-    def scrape_move_list(self):
-        # if len(self.move_list) > 0:
-        #     last_move = self.interface.get_selected_move()  # by default the latest move is selected
-        #     if last_move != self.move_list[-1]:
-        #         self.move_list = self.interface.get_move_list()
-        # else:
-        self.move_list = self.interface.get_move_list()
+                    logger.debug('Exception in multi PV output: %s', e)
+            logger.debug(output_line)
 
     def make_board(self):
-        self.board = chess.Board(START_POS_FEN)
         try:
-            for move in self.move_list:
-                self.board.push_san(move)
+            self.board = self.board_state.update(self.interface.move_log)
         except Exception as e:
             self.board = None
-            print("Exception in pushing moves onto board: {0}".format(e))
-            print(self.board)
+            logger.warning('Exception in pushing moves onto board: %s', e)
+
+    def adopt_speculation(self):
+        """Drop speculation the game has moved away from, and wait on a search already running for this position"""
+        key = chess.polyglot.zobrist_hash(self.board)
+        self.speculator.on_position(key)
+        future = self.speculator.take(key)
+        if future is None:
+            return
+        logger.debug('Speculation hit')
+        if self.pending_eval is not None:
+            self.pending_eval.cancel()
+        self.pending_eval = future
+        self.pending_key = key
+
+    def evaluate(self):
+        """Fill in the engine lines for the current board. Returns False if there is nothing new to draw"""
+        if self.book is not None and self.book_eval():
+            logger.debug('Book move')
+            return True
+        if self.tablebase is not None and self.tablebase_eval():
+            logger.debug('Tablebase position')
+            return True
+        if self.ensemble is not None:
+            return self.ensemble_eval()
+        if self.streaming is not None:
+            return self.stream_eval()
+        if self.engine_pool is not None:
+            return self.pool_eval()
+        return self.engine_eval()
 
     def engine_eval(self):
         try:
-            if self.config['engine'].getboolean('use_multipv') and 'MultiPV' in self.engine.options:
-                self.engine_infos.clear()
-                self.engine_moves.clear()
-                self.engine_scores.clear()
-
-                infos = self.engine.analyse(self.board, self.limit,
-                                            multipv=self.config['engine'].getint('multipv_count'))
-                self.engine_infos = infos
-                for i in range(len(infos)):
-                    info = infos[i]
-                    self.engine_moves.append(info['pv'][0])
-                    self.engine_scores.append(info['score'])
+            multipv = self.settings.multipv(self.engine_manager.engine_options)
+            depth = self.settings.search_depth
+            engine_name = self.cache_name(self.engine_manager.engine_id, self.engine_manager.engine_options)
+            key = chess.polyglot.zobrist_hash(self.board)
+
+            if self.pending_eval is not None and self.pending_key != key:
+                self.pending_eval.cancel()  # speculation for a position the game has left
+                self.pending_eval = None
+
+            entry = self.eval_cache.get(key, depth, multipv, engine_name)
+            speculated = None
+            if entry is None and self.pending_eval is not None:
+                # searched speculatively on the pool before the move was played. Picked up by a later poll
+                # once it finishes, rather than waited on here
+                if not self.pending_eval.done():
+                    return False
+                future = self.pending_eval
+                self.pending_eval = None
+                if not future.cancelled() and future.exception() is None:
+                    speculated = future.result()
+                    if not isinstance(speculated, list):
+                        speculated = [speculated]
+                else:
+                    logger.debug('Speculative search failed, searching again')
+
+            if entry is not None:
+                logger.debug('Evaluation cache hit (%d hits, %d misses)', self.eval_cache.hits,
+                             self.eval_cache.misses)
+                infos = entry.infos[:multipv]
+            elif speculated is not None:
+                infos = speculated
+                self.eval_cache.put(key, infos, depth, multipv, self.speculator.engine_name)
             else:
-                info = self.engine.analyse(self.board, self.limit)
-                self.engine_moves = [info['pv'][0]]
-                self.engine_scores = [info['score']]
+                if multipv > 1:
+                    infos = self.engine_manager.analyse(self.board, self.limit, multipv=multipv)
+                else:
+                    infos = [self.engine_manager.analyse(self.board, self.limit)]
+                # the fallback engine may have answered instead
+                self.eval_cache.put(key, infos, depth, multipv,
+                                    self.cache_name(self.engine_manager.last_engine.id,
+                                                    self.engine_manager.last_engine.options))
+
+            self.set_engine_infos(infos)
+            return True
         except Exception as e:
-            print('Exception in evaluating: {0}'.format(e))
-            print('Falling back on Stockfish')
-
-            self.load_engine('stockfish')
-            self.engine_eval()
-            self.load_engine(self.config['engine']['name'])
+            logger.error('Exception in evaluating: %s', e)
+            logger.error('Engine stats: %s', self.engine_manager.stats())
+            raise
+
+    def book_eval(self):
+        multipv = self.settings.multipv()
+        infos = self.book.probe(self.board, chess.polyglot.zobrist_hash(self.board), multipv)
+        if infos is None:
+            return False
+
+        if self.streaming is not None:
+            self.streaming.stop()  # no point searching a position the book already covers
+        self.set_engine_infos(infos)
+        return True
+
+    def tablebase_eval(self):
+        multipv = self.settings.multipv()
+        infos = self.tablebase.probe(self.board, chess.polyglot.zobrist_hash(self.board), multipv)
+        if infos is None:
+            return False
+
+        if self.streaming is not None:
+            self.streaming.stop()  # the tablebase result is exact, so searching cannot improve on it
+        self.set_engine_infos(infos)
+        return True
+
+    def pool_eval(self):
+        multipv = self.settings.multipv(self.engine_pool.engine_options)
+        depth = self.settings.search_depth
+        engine_name = self.cache_name(self.engine_pool.engine_id, self.engine_pool.engine_options)
+        key = chess.polyglot.zobrist_hash(self.board)
+
+        entry = self.eval_cache.get(key, depth, multipv, engine_name)
+        if entry is not None:
+            self.set_engine_infos(entry.infos[:multipv])
+            return True
+
+        if self.pending_eval is not None and self.pending_key != key:
+            self.pending_eval.cancel()  # the position changed before the search finished
+            self.pending_eval = None
+        if self.pending_eval is None:
+            self.pending_eval = self.engine_pool.submit(self.board, self.limit, multipv=multipv,
+                                                        priority=self.eval_priority)
+            self.pending_key = key
+        if not self.pending_eval.done():
+            return False
+
+        future = self.pending_eval
+        self.pending_eval = None
+        infos = future.result()
+        if not isinstance(infos, list):
+            infos = [infos]
+        self.eval_cache.put(key, infos, depth, multipv, engine_name)
+        self.set_engine_infos(infos)
+        return True
+
+    def ensemble_eval(self):
+        multipv = self.settings.multipv()
+        key = chess.polyglot.zobrist_hash(self.board)
+
+        if self.pending_eval is not None and self.pending_key != key:
+            self.pending_eval.cancel()  # the position changed before the engines answered
+            self.pending_eval = None
+        if self.pending_eval is None:
+            self.pending_eval = self.ensemble.submit(self.board, key, multipv)
+            self.pending_key = key
+        if not self.pending_eval.done():
+            return False
+
+        search = self.pending_eval
+        self.pending_eval = None
+        self.set_engine_infos(search.result())
+        return True
+
+    def stream_eval(self):
+        if self.streaming.analyse(self.board):
+            logger.debug('Started streaming analysis')
+        result = self.streaming.poll()
+        if result is None:
+            return False
+        infos, depth = result
+
+        self.eval_cache.put(chess.polyglot.zobrist_hash(self.board), infos, depth,
+                            self.settings.multipv(self.engine_manager.engine_options),
+                            self.cache_name(self.engine_manager.engine_id, self.engine_manager.engine_options))
+        self.set_engine_infos(infos)
+        return True
+
+    def set_engine_infos(self, infos):
+        if self.game_record is not None:
+            self.game_record.record(self.board, infos)
+        self.engine_infos = infos
+        self.engine_moves = [info['pv'][0] for info in infos]
+        self.engine_scores = [info['score'] for info in infos]
 
     def draw_evaluation(self, context, move, score, player):
         main_ctx_name = self.cvs_ctx[0][1]
@@ -249,7 +668,7 @@ class Bot:
             else:
                 fill_style = "'Gray'"
 
-        if self.config['interface'].getboolean('draw_wdl'):
+        if self.settings.draw_wdl:
             pov_wdl = score.wdl(ply=len(self.move_list))
             wdl = pov_wdl.relative
             win_prob, draw_prob, loss_prob = wdl.winning_chance(), wdl.drawing_chance(), wdl.losing_chance()
@@ -263,16 +682,17 @@ class Bot:
     def display_moves(self):
         try:
             main_ctx_name = self.cvs_ctx[0][1]
+            self.interface.graphics.begin_frame()
             self.interface.graphics.clear_context(main_ctx_name)
-            if self.config['engine'].getboolean('use_multipv'):
-                if self.config['interface']['draw_type'] == 'square':
+            if self.settings.use_multipv:
+                if self.settings.draw_type == 'square':
                     for i in range(len(self.engine_moves)):
                         self.interface.graphics.set_styles(main_ctx_name,
                                                            fill_style=MULTIPV_MOVE_COLOURS[
-                                                               i - self.config['engine'].getint('multipv_count')])
+                                                               i - self.settings.multipv_count])
                         self.interface.draw_move_squares(main_ctx_name, self.engine_moves[i], self.player)
                         self.draw_evaluation(main_ctx_name, self.engine_moves[i], self.engine_scores[i], self.player)
-                elif self.config['interface']['draw_type'] == 'arrow':
+                elif self.settings.draw_type == 'arrow':
                     alpha_step = 1 / len(self.engine_moves)
                     for i in range(len(self.engine_moves)):
                         alpha = 1 - (i * alpha_step)
@@ -280,14 +700,18 @@ class Bot:
                         self.interface.draw_move_arrows(main_ctx_name, self.engine_moves[i], self.player)
                         self.draw_evaluation(main_ctx_name, self.engine_moves[i], self.engine_scores[i], self.player)
             else:
-                if self.config['interface']['draw_type'] == 'square':
+                if self.settings.draw_type == 'square':
                     self.interface.graphics.set_styles(main_ctx_name, fill_style="'blue'", global_alpha='0.25')
                     self.interface.draw_move_squares(main_ctx_name, self.engine_moves[0], self.player)
-                elif self.config['interface']['draw_type'] == 'arrow':
+                elif self.settings.draw_type == 'arrow':
                     self.interface.graphics.set_styles(main_ctx_name, fill_style="'black'", global_alpha='1.0')
                     self.interface.draw_move_arrows(main_ctx_name, self.engine_moves[0], self.player)
-                self.interface.draw_move_text(main_ctx_name, self.engine_moves[0], self.engine_scores[0], self.player)
+                self.draw_evaluation(main_ctx_name, self.engine_moves[0], self.engine_scores[0], self.player)
+            if self.interface.graphics.end_frame() and self.first_overlay_time is None:
+                self.first_overlay_time = time.monotonic() - self.start_time
+                logger.info('First overlay drawn %.2f seconds after startup', self.first_overlay_time)
         except Exception as e:
-            print('Exception displaying moves: {0}'.format(e))
-            print('Recreating contexts')
+            self.interface.graphics.discard_frame()
+            logger.warning('Exception displaying moves: %s', e)
+            logger.warning('Recreating contexts')
             self.setup_selenium_chess()
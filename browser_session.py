@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+
+from selenium.common.exceptions import WebDriverException
+
+from constants import SITE_URL, START_URL
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserSession:
+    """Saves the browser's cookies after logging in, so later runs can skip the login form"""
+
+    def __init__(self, driver, cookie_file):
+        self.driver = driver
+        self.cookie_file = cookie_file
+
+    def logged_in(self):
+        # the login page forwards a logged in user on to its return URL instead of showing the form
+        self.driver.get(START_URL)
+        return not self.driver.find_elements_by_id('username')
+
+    def restore(self):
+        """Load the saved cookies. Returns True if they still hold a valid login"""
+        if not self.cookie_file or not os.path.exists(self.cookie_file):
+            return False
+        try:
+            with open(self.cookie_file) as f:
+                cookies = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring saved session %s: %s', self.cookie_file, e)
+            return False
+
+        # cookies can only be set for the site that is open
+        self.driver.get(SITE_URL)
+        for cookie in cookies:
+            try:
+                self.driver.add_cookie(cookie)
+            except WebDriverException as e:
+                logger.debug('Skipping saved cookie %s: %s', cookie.get('name'), e)
+        return self.logged_in()
+
+    def save(self):
+        if not self.cookie_file:
+            return
+        temp_path = self.cookie_file + '.tmp'
+        # the cookies are as good as the password, so only the user may read them
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(self.driver.get_cookies(), f)
+        os.replace(temp_path, self.cookie_file)
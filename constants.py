@@ -9,8 +9,14 @@ class Side(Enum):
 
 MULTIPV_MOVE_COLOURS = ["'red'", "'salmon'", "'darkred'"]
 
+SITE_URL = 'https://www.chess.com/'
 START_URL = 'https://www.chess.com/login_and_go?returnUrl=https%3A//www.chess.com/register'
 PLAY_CHESS_URL = 'https://www.chess.com/play/'
+# seconds an asynchronous script may run before WebDriver gives up on it
+SCRIPT_TIMEOUT = 5
+# longest the page is asked to wait for a move in one script, leaving time for the round trip within SCRIPT_TIMEOUT
+MAX_PAGE_WAIT = SCRIPT_TIMEOUT - 1
+
 START_POS_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
 
 if os.name == 'nt':
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def engine_path(config, engine_name):
+    path = config['engine']['directory'] + '/'
+    if os.name == 'nt':  # Windows
+        path += config['engine_paths_windows'][engine_name]
+    elif os.name == 'posix':
+        path += config['engine_paths_linux'][engine_name]
+    else:
+        raise Exception('Unknown operating system: {0}'.format(os.name))
+    return path
+
+
+def requested_options(config):
+    return strength_options(config['engine'].getint('elo'))
+
+
+def strength_options(elo):
+    return {'UCI_LimitStrength': 'true',
+            'UCI_Elo': elo}
+
+
+def cache_engine_name(engine_name, options, available_options):
+    """Name an engine's evaluations are cached under. Lines searched at one strength are no use at another,
+    so a limited strength is part of the name, if the engine takes the options that limit it"""
+    if 'UCI_LimitStrength' not in available_options or 'UCI_Elo' not in available_options or \
+            str(options.get('UCI_LimitStrength', '')).lower() != 'true':
+        return engine_name
+    return '{0} (Elo {1})'.format(engine_name or '', options.get('UCI_Elo'))
+
+
+def engine_options(config, available_options):
+    """Options from the [engine] section which the engine supports"""
+    return supported_options(requested_options(config), available_options)
+
+
+def supported_options(options, available_options):
+    options = dict(options)
+    for option in list(options.keys()):
+        if option not in available_options:
+            logger.info('%s is not an option for this engine', option)
+            del options[option]
+
+    return options
+
+
+def pool_setting(config, engine_name, setting):
+    """Look up an [engine_pool] setting, preferring an override for this engine such as stockfish_workers"""
+    pool_config = config['engine_pool']
+    return pool_config.getint(f'{engine_name}_{setting}', fallback=pool_config.getint(setting))
+
+
+class EngineInfoCache:
+    """Engine ids and option names from earlier handshakes, keyed by executable and its modification time,
+    so they are known before the engine has started"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Ignoring engine info cache %s: %s', path, e)
+
+    @staticmethod
+    def key(engine_file):
+        try:
+            return '{0}:{1}'.format(os.path.abspath(engine_file), os.path.getmtime(engine_file))
+        except OSError:
+            return None
+
+    def get(self, engine_file):
+        """Returns {'id': ..., 'options': [...]} or None if the engine has not been seen in this version"""
+        with self.lock:
+            return self.entries.get(EngineInfoCache.key(engine_file))
+
+    def check(self, engine_file, engine):
+        """Compare a finished handshake with the cache, updating it if the engine was new or has changed"""
+        key = EngineInfoCache.key(engine_file)
+        entry = {'id': dict(engine.id), 'options': sorted(engine.options)}
+        with self.lock:
+            if key is None or self.entries.get(key) == entry:
+                return
+            if key in self.entries:
+                logger.info('Engine %s reported a different id or options than cached', engine_file)
+            self.entries[key] = entry
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(temp_path, self.path)
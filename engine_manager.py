@@ -0,0 +1,239 @@
+import logging
+import threading
+import time
+
+import chess.engine
+
+from engine_config import engine_path, requested_options, supported_options
+
+logger = logging.getLogger(__name__)
+
+
+class EngineSupervisor:
+    def __init__(self, config, engine_name, fallback_name='stockfish', initial_backoff=1, max_backoff=60,
+                 health_check_interval=10, info_cache=None):
+        self.config = config
+        self.engine_name = engine_name
+        self.fallback_name = fallback_name
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.health_check_interval = health_check_interval
+        self.info_cache = info_cache
+        self.options = requested_options(config)  # also given to engines started after a reconfiguration
+
+        self.failures = 0
+        self.restarts = 0
+        self.fallback_searches = 0
+        self.fallback_failures = 0
+        self.backoff = initial_backoff
+        self.next_restart_time = 0
+        self.last_health_check = time.monotonic()
+        self.last_fallback_check = time.monotonic()
+
+        self.primary = None
+        self.fallback = None
+        self.last_engine = None
+        self.analysis_engine = None  # engine of the last search started by analysis()
+        self.start_error = None
+        # engines start in the background; until they have, their id and options come from info_cache
+        self.started = threading.Event()
+        threading.Thread(target=self.start, daemon=True).start()
+
+    def start(self):
+        try:
+            start_time = time.monotonic()
+            try:
+                self.primary = self.popen(self.engine_name)
+                logger.debug('Engine options: %s', list(self.primary.options.values()))
+            except Exception as e:
+                self.primary_failed(e)  # restarted with backoff while the fallback searches
+
+            # kept running so a failure never waits on a process startup; a process of its own even when it is
+            # the same engine, since a crashed primary cannot stand in for itself
+            try:
+                self.fallback = self.popen(self.fallback_name)
+            except Exception as e:
+                self.fallback_failed(e)
+
+            if self.primary is None and self.fallback is None:
+                raise Exception('Neither {0} nor the fallback {1} could be started'.format(self.engine_name,
+                                                                                         self.fallback_name))
+            self.last_engine = self.engine_running()
+            logger.info('Engines started in %.2f seconds', time.monotonic() - start_time)
+        except Exception as e:
+            self.start_error = e
+        finally:
+            self.started.set()
+
+    def wait_started(self):
+        self.started.wait()
+        if self.start_error is not None:
+            raise self.start_error
+
+    @property
+    def engine(self):
+        """The engine that will handle the next search"""
+        self.wait_started()
+        return self.engine_running()
+
+    def engine_running(self):
+        return self.primary if self.primary is not None else self.fallback
+
+    def cached_info(self):
+        if self.started.is_set() or self.info_cache is None:
+            return None
+        return self.info_cache.get(engine_path(self.config, self.engine_name))
+
+    @property
+    def engine_id(self):
+        info = self.cached_info()
+        return info['id'] if info is not None else self.engine.id
+
+    @property
+    def engine_options(self):
+        """Option names of the engine, from the cache while it is still starting"""
+        info = self.cached_info()
+        return info['options'] if info is not None else self.engine.options
+
+    def popen(self, engine_name):
+        path = engine_path(self.config, engine_name)
+        if self.config['engine']['protocol'] == 'xboard':
+            engine = chess.engine.SimpleEngine.popen_xboard(path)
+        else:
+            engine = chess.engine.SimpleEngine.popen_uci(path)
+
+        if 'name' in engine.id:
+            logger.info('Loaded engine %s', engine.id['name'])
+        else:
+            logger.info('Engine name is unknown')
+
+        engine.configure(supported_options(self.options, engine.options))
+        if self.info_cache is not None:
+            self.info_cache.check(path, engine)
+        return engine
+
+    def close(self, engine):
+        try:
+            engine.quit()
+        except Exception:
+            engine.close()
+
+    def primary_failed(self, exception):
+        self.failures += 1
+        logger.error('Engine %s failed (%d failures): %s', self.engine_name, self.failures, exception)
+        if self.primary is not None:
+            self.close(self.primary)
+            self.primary = None
+        self.next_restart_time = time.monotonic() + self.backoff
+        logger.warning('Restarting %s in %s seconds', self.engine_name, self.backoff)
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def fallback_failed(self, exception):
+        self.fallback_failures += 1
+        logger.error('Fallback engine %s failed: %s', self.fallback_name, exception)
+        if self.fallback is not None:
+            self.close(self.fallback)
+            self.fallback = None
+
+    def check_fallback(self):
+        """Ping the fallback, and start it again if it has died or never started"""
+        if self.fallback is not None:
+            try:
+                self.fallback.ping()
+                return
+            except Exception as e:
+                self.fallback_failed(e)
+        try:
+            self.fallback = self.popen(self.fallback_name)
+        except Exception as e:
+            self.fallback_failed(e)
+
+    def check_primary(self):
+        self.wait_started()
+        now = time.monotonic()
+        if self.primary is None:
+            if now < self.next_restart_time:
+                return
+            try:
+                self.primary = self.popen(self.engine_name)
+                self.restarts += 1
+                self.last_health_check = now
+            except Exception as e:
+                self.primary_failed(e)
+        elif now - self.last_health_check >= self.health_check_interval:
+            self.last_health_check = now
+            try:
+                self.primary.ping()
+            except Exception as e:
+                self.primary_failed(e)
+        if now - self.last_fallback_check >= self.health_check_interval:
+            self.last_fallback_check = now
+            self.check_fallback()
+
+    def analyse(self, board, limit, **kwargs):
+        self.check_primary()
+        if self.primary is not None:
+            try:
+                result = self.primary.analyse(board, limit, **kwargs)
+                self.backoff = self.initial_backoff
+                self.last_engine = self.primary
+                return result
+            except Exception as e:
+                self.primary_failed(e)
+
+        if self.fallback is None:
+            raise Exception('Engine {0} is unavailable and there is no fallback engine'.format(self.engine_name))
+        logger.warning('Falling back on %s', self.fallback_name)
+        self.fallback_searches += 1
+        self.last_engine = self.fallback
+        try:
+            return self.fallback.analyse(board, limit, **kwargs)
+        except Exception as e:
+            self.fallback_failed(e)
+            raise
+
+    def analysis(self, board, limit=None, **kwargs):
+        self.check_primary()
+        if self.primary is not None:
+            try:
+                analysis = self.primary.analysis(board, limit, **kwargs)
+                self.analysis_engine = self.primary
+                return analysis
+            except Exception as e:
+                self.primary_failed(e)
+        if self.fallback is None:
+            raise Exception('Engine {0} is unavailable and there is no fallback engine'.format(self.engine_name))
+        self.fallback_searches += 1
+        self.analysis_engine = self.fallback
+        try:
+            return self.fallback.analysis(board, limit, **kwargs)
+        except Exception as e:
+            self.fallback_failed(e)
+            raise
+
+    def analysis_failed(self, exception):
+        """Report that the search last started by analysis() ended in exception, so a failed primary is restarted"""
+        if self.analysis_engine is not None and self.analysis_engine is self.primary:
+            self.primary_failed(exception)
+        elif self.analysis_engine is not None and self.analysis_engine is self.fallback:
+            self.fallback_failed(exception)
+        self.analysis_engine = None
+
+    def configure(self, options):
+        """Change engine options on the running engines and any started later"""
+        self.wait_started()
+        self.options.update(options)
+        for engine in (self.primary, self.fallback):
+            if engine is not None:
+                engine.configure(supported_options(options, engine.options))
+
+    def stats(self):
+        return {'failures': self.failures, 'restarts': self.restarts, 'fallback_searches': self.fallback_searches,
+                'fallback_failures': self.fallback_failures, 'primary_running': self.primary is not None,
+                'fallback_running': self.fallback is not None}
+
+    def quit(self):
+        self.started.wait()
+        for engine in (self.primary, self.fallback):
+            if engine is not None:
+                self.close(engine)
@@ -0,0 +1,224 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+
+import chess.engine
+
+logger = logging.getLogger(__name__)
+
+
+class EngineRequest:
+    def __init__(self, board, limit, multipv, timeout, partial=False):
+        self.board = board.copy(stack=False)
+        self.limit = limit
+        self.multipv = multipv
+        self.timeout = timeout
+        self.partial = partial
+        self.future = concurrent.futures.Future()
+        # seconds an engine spent on this request, final once search_finished is set
+        self.future.search_time = 0.0
+        self.future.search_finished = False
+        # for partial requests, the lines of the deepest complete iteration so far
+        self.future.partial_infos = None
+        self.task = None
+
+
+class EnginePool:
+    def __init__(self, command, workers=1, threads=1, hash_size=16, options=None, protocol='uci', timeout=None,
+                 restart_attempts=5, initial_backoff=1, max_backoff=60):
+        self.command = command
+        self.worker_count = workers
+        self.protocol = protocol
+        self.timeout = timeout
+        self.restart_attempts = restart_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.options = dict(options) if options is not None else {}
+        self.options['Threads'] = threads
+        self.options['Hash'] = hash_size
+
+        self.engines = []
+        self.workers = []
+        self.option_changes = []  # options changed by configure, in order
+        self.configured = []  # how many of the option changes each worker's engine has been given
+        self.queue = None
+        self.sequence = itertools.count()  # keeps requests of equal priority in submission order
+        self.closing = False
+        self.live_workers = 0  # workers whose engine is running or being restarted
+
+        # the pool's engines live on their own event loop so requests never block the caller
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    def run_loop(self):
+        # python-chess's event loop policy only watches engine subprocesses on a loop set for the current thread
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @property
+    def engine_id(self):
+        return self.engines[0][1].id
+
+    @property
+    def engine_options(self):
+        return self.engines[0][1].options
+
+    async def popen(self):
+        if self.protocol == 'xboard':
+            transport, engine = await chess.engine.popen_xboard(self.command)
+        else:
+            transport, engine = await chess.engine.popen_uci(self.command)
+        await engine.configure({name: value for name, value in self.options.items() if name in engine.options})
+        return transport, engine
+
+    async def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.engines = await asyncio.gather(*[self.popen() for _ in range(self.worker_count)])
+        self.configured = [0] * self.worker_count
+        self.live_workers = self.worker_count
+        self.workers = [self.loop.create_task(self.work(i)) for i in range(self.worker_count)]
+        logger.info('Started %d %s workers', self.worker_count, self.engine_id.get('name', 'engine'))
+
+    async def work(self, index):
+        while True:
+            _, _, request = await self.queue.get()
+            if request.future.done():
+                request.future.search_finished = True
+                continue  # cancelled while waiting in the queue
+
+            _, engine = self.engines[index]
+            for options in self.option_changes[self.configured[index]:]:
+                await engine.configure({name: value for name, value in options.items() if name in engine.options})
+            self.configured[index] = len(self.option_changes)
+            if request.partial:
+                request.task = self.loop.create_task(self.analyse_partial(engine, request))
+            else:
+                request.task = self.loop.create_task(engine.analyse(request.board, request.limit,
+                                                                    multipv=request.multipv))
+            start_time = time.monotonic()
+            try:
+                timeout = request.timeout if request.timeout is not None else self.timeout
+                result = await asyncio.wait_for(request.task, timeout)
+                request.future.search_time = time.monotonic() - start_time
+                if not request.future.done():
+                    request.future.set_result(result)
+            except asyncio.CancelledError:
+                if self.closing:
+                    raise
+            except asyncio.TimeoutError:
+                if not request.future.done():
+                    request.future.set_exception(TimeoutError('Engine request timed out'))
+            except chess.engine.EngineTerminatedError as e:
+                if not request.future.done():
+                    request.future.set_exception(e)
+                logger.error('Engine worker %d terminated, restarting', index)
+                if not await self.restart(index):
+                    self.worker_stopped(index, e)
+                    return
+            except Exception as e:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            finally:
+                request.future.search_time = time.monotonic() - start_time
+                request.future.search_finished = True
+
+    async def restart(self, index):
+        """Replace the engine of a worker, retrying with backoff. False if it could not be started"""
+        backoff = self.initial_backoff
+        for attempt in range(1, self.restart_attempts + 1):
+            try:
+                self.engines[index] = await self.popen()
+                self.configured[index] = len(self.option_changes)
+                return True
+            except Exception as e:
+                logger.error('Could not restart engine worker %d (attempt %d of %d): %s', index, attempt,
+                             self.restart_attempts, e)
+            if attempt < self.restart_attempts:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        return False
+
+    def worker_stopped(self, index, exception):
+        self.live_workers -= 1
+        logger.error('Engine worker %d has stopped, %d left', index, self.live_workers)
+        if self.live_workers > 0:
+            return
+        # nothing is left to search the queue, so its requests would otherwise never finish
+        while not self.queue.empty():
+            _, _, request = self.queue.get_nowait()
+            self.fail(request, exception)
+
+    def fail(self, request, exception):
+        request.future.search_finished = True
+        if not request.future.done():
+            request.future.set_exception(exception)
+
+    def enqueue(self, priority, request):
+        if self.live_workers == 0:
+            self.fail(request, chess.engine.EngineTerminatedError('Every engine of the pool has stopped'))
+            return
+        self.queue.put_nowait((priority, next(self.sequence), request))
+
+    async def analyse_partial(self, engine, request):
+        """Like engine.analyse, but publishes the lines on the request's future after every complete iteration"""
+        expected_lines = min(request.multipv or 1, request.board.legal_moves.count())
+        lines = {}
+        with await engine.analysis(request.board, request.limit, multipv=request.multipv) as analysis:
+            async for info in analysis:
+                if 'pv' not in info or 'score' not in info:
+                    continue  # e.g. currmove updates
+                line = info.get('multipv', 1)
+                lines[line] = info
+                if line == expected_lines and len(lines) >= expected_lines:
+                    # replaced rather than updated, so other threads always see a whole iteration
+                    request.future.partial_infos = [lines[i] for i in range(1, expected_lines + 1)]
+        return analysis.multipv if request.multipv is not None else analysis.info
+
+    def change_options(self, options):
+        self.options.update(options)
+        self.option_changes.append(dict(options))
+
+    def configure(self, options):
+        """Change engine options. Each worker applies them before its next search, so none is interrupted"""
+        self.loop.call_soon_threadsafe(self.change_options, options)
+
+    def cancel_task(self, request):
+        if request.task is not None and not request.task.done():
+            request.task.cancel()
+
+    def submit(self, board, limit, multipv=None, timeout=None, priority=0, partial=False):
+        """Queue an analysis of board and return a concurrent.futures.Future for its result.
+        Requests with a lower priority number are searched first.
+        Cancelling the future also stops the search if it has already started.
+        With partial, the future's partial_infos holds the lines found so far while the search runs."""
+        request = EngineRequest(board, limit, multipv, timeout, partial)
+        request.future.add_done_callback(
+            lambda future: future.cancelled() and self.loop.call_soon_threadsafe(self.cancel_task, request))
+        self.loop.call_soon_threadsafe(self.enqueue, priority, request)
+        return request.future
+
+    def analyse_many(self, boards, limit, multipv=None, timeout=None):
+        """Analyse several positions at once and wait for all of them. Failed requests give None"""
+        futures = [self.submit(board, limit, multipv, timeout) for board in boards]
+        concurrent.futures.wait(futures)
+        return [future.result() if future.exception() is None else None for future in futures]
+
+    async def close(self):
+        self.closing = True
+        for worker in self.workers:
+            worker.cancel()
+        for _, engine in self.engines:
+            try:
+                await asyncio.wait_for(engine.quit(), 5)
+            except Exception as e:
+                logger.warning('Exception closing engine worker: %s', e)
+
+    def quit(self):
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,184 @@
+import logging
+import time
+
+from engine_config import cache_engine_name, engine_path, pool_setting, requested_options
+from engine_pool import EnginePool
+
+logger = logging.getLogger(__name__)
+
+
+class EnsembleMember:
+    def __init__(self, name, pool, deadline):
+        self.name = name  # as in [engine_paths_*]
+        self.pool = pool
+        self.deadline = deadline  # seconds a search may take before it is stopped and its lines so far are used
+
+        self.searches = 0
+        self.on_time = 0
+        self.late = 0
+        self.failures = 0
+        self.cache_hits = 0
+
+    @property
+    def engine_name(self):
+        return self.pool.engine_id.get('name', self.name)
+
+    def cache_name(self, options):
+        return cache_engine_name(self.engine_name, options, self.pool.engine_options)
+
+    def multipv(self, multipv):
+        return multipv if 'MultiPV' in self.pool.engine_options else 1
+
+
+class EnsembleSearch:
+    """One position searched by every member at once. Behaves enough like a future for the bot's pending_eval:
+    it is done once each member has answered or run out of time, and cancelling it stops the searches still running.
+    A member out of time contributes the lines of its last complete iteration, which are not cached."""
+
+    def __init__(self, ensemble, board, key, multipv):
+        self.ensemble = ensemble
+        self.board = board.copy(stack=False)
+        self.key = key
+        self.multipv = multipv
+        self.start_time = time.monotonic()
+        self.results = {}  # member -> infos, for members which have finished or run out of time
+        self.futures = {}  # member -> future of a search still running
+
+        for member in ensemble.members:
+            member_multipv = member.multipv(multipv)
+            entry = ensemble.cache.get(key, ensemble.depth, member_multipv, member.cache_name(ensemble.options))
+            if entry is not None:
+                member.cache_hits += 1
+                self.results[member] = entry.infos[:member_multipv]
+                continue
+            member.searches += 1
+            # the pool stops the engine at the deadline too, so a late engine is free for the next position
+            self.futures[member] = member.pool.submit(board, ensemble.limit, multipv=member_multipv,
+                                                      timeout=member.deadline, partial=True)
+
+    def time_left(self):
+        """Seconds until the next deadline of a member still searching, or None if none are"""
+        if not self.futures:
+            return None
+        elapsed = time.monotonic() - self.start_time
+        return max(0.0, min(member.deadline for member in self.futures) - elapsed)
+
+    def collect(self):
+        elapsed = time.monotonic() - self.start_time
+        for member, future in list(self.futures.items()):
+            if future.done() and not future.cancelled() and future.exception() is None:
+                del self.futures[member]
+                member.on_time += 1
+                infos = future.result()
+                if not isinstance(infos, list):
+                    infos = [infos]
+                self.results[member] = infos
+                self.ensemble.cache.put(self.key, infos, self.ensemble.depth, member.multipv(self.multipv),
+                                        member.cache_name(self.ensemble.options))
+            elif future.done() or elapsed >= member.deadline:
+                del self.futures[member]
+                future.cancel()
+                # a timed out search is as late as one still running; either way the lines found so far count
+                if elapsed >= member.deadline:
+                    member.late += 1
+                else:
+                    member.failures += 1
+                    logger.debug('Ensemble engine %s failed: %s', member.name, future.exception())
+                if future.partial_infos:
+                    self.results[member] = future.partial_infos
+
+    def done(self):
+        self.collect()
+        return not self.futures
+
+    def cancel(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+    def result(self):
+        """Merged lines of every member which found any in time"""
+        self.collect()
+        self.cancel()
+        if not self.results:
+            raise Exception('No ensemble engine answered before its deadline')
+        return self.ensemble.merge(self.board, self.results, self.multipv)
+
+
+class Ensemble:
+    """Searches each position on several engines at once, each in its own process with its own deadline,
+    and merges whatever lines arrive in time. A slow or crashed engine only loses its say in the result."""
+
+    def __init__(self, members, cache, limit, depth, options):
+        self.members = members  # in order of preference when engines disagree about equal scores
+        self.cache = cache
+        self.limit = limit
+        self.depth = depth
+        self.options = dict(options)  # strength the members are set to, part of the name their lines are cached under
+
+    @classmethod
+    def from_config(cls, config, cache, limit):
+        section = config['ensemble']
+        members = []
+        for name in [name.strip() for name in section['engines'].split(',') if name.strip()]:
+            try:
+                pool = EnginePool(engine_path(config, name),
+                                  workers=1,
+                                  threads=pool_setting(config, name, 'threads'),
+                                  hash_size=pool_setting(config, name, 'hash'),
+                                  options=requested_options(config),
+                                  protocol=config['engine']['protocol'])
+            except Exception as e:
+                logger.error('Could not start ensemble engine %s: %s', name, e)
+                continue
+            members.append(EnsembleMember(name, pool, section.getfloat(f'{name}_deadline',
+                                                                       fallback=section.getfloat('deadline'))))
+        if not members:
+            raise Exception('None of the ensemble engines could be started')
+        logger.info('Ensemble of %s', ', '.join(member.engine_name for member in members))
+        return cls(members, cache, limit, config['engine'].getint('search_depth'), requested_options(config))
+
+    def submit(self, board, key, multipv):
+        return EnsembleSearch(self, board, key, multipv)
+
+    def merge(self, board, results, multipv):
+        """Combine each member's lines into one list of InfoDicts, best first.
+        A move suggested by several engines takes the score of the deepest search, and lists every engine in 'engines'"""
+        lines = {}  # move -> merged InfoDict
+        for member in self.members:
+            for info in results.get(member, []):
+                if not info.get('pv') or 'score' not in info:
+                    continue
+                move = info['pv'][0]
+                line = lines.get(move)
+                if line is None:
+                    lines[move] = dict(info, engines=[member.engine_name])
+                    continue
+                line['engines'].append(member.engine_name)
+                if info.get('depth', 0) > line.get('depth', 0):
+                    line.update(info, engines=line['engines'])
+
+        # sorted is stable, so members earlier in the list win ties
+        merged = sorted(lines.values(), key=lambda line: line['score'].pov(board.turn), reverse=True)[:multipv]
+        for i, line in enumerate(merged):
+            line['multipv'] = i + 1
+        return merged
+
+    def configure(self, options):
+        self.options.update(options)
+        for member in self.members:
+            member.pool.configure(options)
+
+    def stats(self):
+        stats = {}
+        for member in self.members:
+            stats[f'{member.name}_searches'] = member.searches
+            stats[f'{member.name}_on_time'] = member.on_time
+            stats[f'{member.name}_late'] = member.late
+            stats[f'{member.name}_failures'] = member.failures
+            stats[f'{member.name}_cache_hits'] = member.cache_hits
+        return stats
+
+    def quit(self):
+        for member in self.members:
+            member.pool.quit()
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+
+class CacheEntry:
+    def __init__(self, infos, depth, multipv, engine_name):
+        self.infos = infos
+        self.depth = depth
+        self.multipv = multipv
+        self.engine_name = engine_name
+
+    def satisfies(self, depth, multipv, engine_name=None):
+        if engine_name is not None and self.engine_name != engine_name:
+            return False
+        return self.depth >= depth and self.multipv >= multipv
+
+
+class EvaluationCache:
+    # how many of the least recently used entries to consider when picking one to evict
+    EVICTION_SAMPLE = 8
+
+    def __init__(self, max_size=50000, store=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # zobrist hash -> CacheEntry, least recently used first
+        # a PositionStore behind the cache, which is consulted on misses and keeps every result across sessions
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, depth, multipv, engine_name=None):
+        """Return the cached entry for key if it was searched at least as deep and wide as requested"""
+        entry = self.entries.get(key)
+        if entry is None or not entry.satisfies(depth, multipv, engine_name):
+            stored = self.store.get(key, depth, multipv, engine_name) if self.store is not None else None
+            if stored is None:
+                self.misses += 1
+                return None
+            # searched in an earlier session
+            entry = self.insert(key, stored.infos, stored.depth, stored.multipv, stored.engine_name)
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, infos, depth, multipv, engine_name):
+        existing = self.entries.get(key)
+        if existing is not None and existing.satisfies(depth, multipv, engine_name):
+            self.entries.move_to_end(key)  # never replace a deeper result with a shallower one
+            return existing
+
+        if self.store is not None:
+            self.store.put(key, infos, depth, multipv, engine_name)
+        return self.insert(key, infos, depth, multipv, engine_name)
+
+    def insert(self, key, infos, depth, multipv, engine_name):
+        entry = CacheEntry(infos, depth, multipv, engine_name)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.evict()
+        return entry
+
+    def warm(self, count):
+        """Load the positions most recently used in earlier sessions from the store"""
+        loaded = 0
+        for key, stored in reversed(list(self.store.recent(min(count, self.max_size)))):
+            if key not in self.entries:
+                self.insert(key, stored.infos, stored.depth, stored.multipv, stored.engine_name)
+                loaded += 1
+        return loaded
+
+    def evict(self):
+        # Drop the shallowest of the least recently used entries, since deep searches are the most costly to redo
+        candidates = []
+        for key, entry in self.entries.items():
+            candidates.append((entry.depth, len(candidates), key))
+            if len(candidates) >= EvaluationCache.EVICTION_SAMPLE:
+                break
+        _, _, key = min(candidates)
+        del self.entries[key]
+        self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0.0
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': hit_rate}
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import chess
+import chess.engine
+import chess.polyglot
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# behind the current position's searches, speculation and idle boards on a shared pool
+REVIEW_PRIORITY = 3
+# centipawns a mate counts as, and the most a single move can lose, so one missed mate does not swamp the averages
+MATE_SCORE = 10000
+MAX_LOSS = 1000
+# drops in expected score, from 0 to 1, of the side that moved
+INACCURACY = 0.1
+MISTAKE = 0.2
+BLUNDER = 0.3
+# depth recorded for tablebase results, which no search needs to repeat
+EXACT_DEPTH = 1000
+
+PLY_DTYPE = np.dtype([('key', np.uint64),  # zobrist hash of the position, to tell games apart
+                      ('evaluated', np.bool_),
+                      ('cp', np.int32),  # from white's point of view, mates as +-MATE_SCORE
+                      ('mate', np.bool_),
+                      ('depth', np.int16),
+                      ('best_move', 'U5')])
+
+
+class GameRecord:
+    """The best line found for each position of a game while it was played, indexed by ply"""
+
+    def __init__(self, capacity=256):
+        self.plies = np.zeros(capacity, dtype=PLY_DTYPE)
+
+    def record(self, board, infos):
+        info = infos[0] if infos else {}
+        if 'score' not in info or not info.get('pv') or 'book_weight' in info:
+            return  # book moves have no real score
+        ply = len(board.move_stack)
+        if ply >= len(self.plies):
+            self.plies = np.concatenate([self.plies, np.zeros(max(ply + 1, len(self.plies)), dtype=PLY_DTYPE)])
+
+        key = chess.polyglot.zobrist_hash(board)
+        # tablebase lines are the only ones with no depth and a tablebase hit
+        depth = EXACT_DEPTH if info.get('tbhits') and not info.get('depth') else info.get('depth', 0)
+        entry = self.plies[ply]
+        if entry['evaluated'] and entry['key'] == key and entry['depth'] > depth:
+            return
+
+        score = info['score'].white()
+        self.plies[ply] = (key, True, score.score(mate_score=MATE_SCORE), score.is_mate(), depth, info['pv'][0].uci())
+
+
+class GameReviewer:
+    """Reviews finished games on a background thread and writes each review to a JSON file.
+    Positions that were not searched during the game, or not deeply enough, are searched on the engine pool first."""
+
+    def __init__(self, pool, depth, directory):
+        self.pool = pool
+        self.depth = depth
+        self.directory = directory
+        self.games = queue.Queue()
+
+        self.reviewed = 0
+        self.reused_plies = 0
+        self.searched_plies = 0
+
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config, pool):
+        return cls(pool, config['review'].getint('depth'), config['review']['directory'])
+
+    def submit(self, record, board, details):
+        """Queue a finished game for review. record is handed over, so the caller should start a new one"""
+        if not board.move_stack:
+            logger.debug('Not reviewing a game without moves')
+            return
+        self.games.put((record, board.copy(), details))
+
+    def run(self):
+        while True:
+            record, board, details = self.games.get()
+            try:
+                path = self.write(self.review(record, board, details))
+                self.reviewed += 1
+                logger.info('Game review written to %s', path)
+            except Exception:
+                logger.exception('Exception reviewing game')
+
+    def review(self, record, board, details):
+        moves = list(board.move_stack)
+        positions = [board.root()]
+        for move in moves:
+            position = positions[-1].copy(stack=False)
+            position.push(move)
+            positions.append(position)
+        count = len(positions)
+
+        plies = record.plies[:count] if len(record.plies) >= count else \
+            np.concatenate([record.plies, np.zeros(count - len(record.plies), dtype=PLY_DTYPE)])
+        keys = np.array([chess.polyglot.zobrist_hash(position) for position in positions], dtype=np.uint64)
+        # entries left over from another game on the same board do not count
+        known = plies['evaluated'] & (plies['key'] == keys)
+        cp = np.where(known, plies['cp'], 0).astype(np.float64)
+        mate = known & plies['mate']
+        best_moves = np.where(known, plies['best_move'], '')
+
+        deep_enough = known & (plies['depth'] >= self.depth)
+
+        final = positions[-1]
+        if final.is_checkmate():
+            cp[-1] = -MATE_SCORE if final.turn == chess.WHITE else MATE_SCORE
+            mate[-1] = known[-1] = deep_enough[-1] = True
+        elif final.is_game_over():
+            cp[-1] = 0
+            known[-1] = deep_enough[-1] = True
+
+        shallow = np.flatnonzero(~deep_enough)
+        self.reused_plies += int(np.count_nonzero(deep_enough))
+        futures = {int(ply): self.pool.submit(positions[ply], chess.engine.Limit(depth=self.depth),
+                                              priority=REVIEW_PRIORITY) for ply in shallow}
+        for ply, future in futures.items():
+            try:
+                info = future.result()
+            except Exception as e:
+                logger.warning('Could not analyse ply %d for the review: %s', ply, e)
+                continue
+            score = info['score'].white()
+            cp[ply] = score.score(mate_score=MATE_SCORE)
+            mate[ply] = score.is_mate()
+            best_moves[ply] = info['pv'][0].uci() if info.get('pv') else ''
+            known[ply] = True
+            self.searched_plies += 1
+
+        cp[~known] = np.nan
+        # +1 where white is to move, -1 for black, so losses are from the mover's point of view
+        sign = np.array([1 if position.turn == chess.WHITE else -1 for position in positions[:-1]])
+        cp_loss = np.clip((cp[:-1] - cp[1:]) * sign, 0, MAX_LOSS)
+
+        expectation = np.full(count, np.nan)
+        for ply in np.flatnonzero(known):
+            # mates count as MATE_SCORE, where the model is already certain of the result
+            score = chess.engine.PovScore(chess.engine.Cp(int(cp[ply])), chess.WHITE)
+            expectation[ply] = score.wdl(ply=int(ply)).white().expectation()
+        best = np.array([move.uci() for move in moves]) == best_moves[:-1] if moves else np.array([], dtype=bool)
+        swing = (expectation[:-1] - expectation[1:]) * sign
+        # the best move loses nothing; a drop there is only the two searches disagreeing
+        swing[best] = 0
+        # the accuracy formula lichess uses, on win percentages
+        accuracy = np.clip(103.1668 * np.exp(-0.04354 * np.maximum(swing, 0) * 100) - 3.1669, 0, 100)
+        classification = np.select([swing >= BLUNDER, swing >= MISTAKE, swing >= INACCURACY],
+                                   ['blunder', 'mistake', 'inaccuracy'], '')
+
+        def side_summary(side_sign):
+            mask = sign == side_sign
+            return {'average_centipawn_loss': known_mean(cp_loss[mask]),
+                    'accuracy': known_mean(accuracy[mask]),
+                    'inaccuracies': int(np.count_nonzero(classification[mask] == 'inaccuracy')),
+                    'mistakes': int(np.count_nonzero(classification[mask] == 'mistake')),
+                    'blunders': int(np.count_nonzero(classification[mask] == 'blunder')),
+                    'best_moves': int(np.count_nonzero(best[mask]))}
+
+        return dict(details,
+                    moves=len(moves),
+                    searched_plies=len(futures),
+                    white=side_summary(1),
+                    black=side_summary(-1),
+                    plies=[{'ply': ply + 1,
+                            'move': positions[ply].san(moves[ply]),
+                            'best_move': str(best_moves[ply]) or None,
+                            'score_before': nan_to_none(cp[ply]),
+                            'score_after': nan_to_none(cp[ply + 1]),
+                            'mate_after': bool(mate[ply + 1]),
+                            'centipawn_loss': nan_to_none(cp_loss[ply]),
+                            'expectation_swing': nan_to_none(swing[ply]),
+                            'classification': str(classification[ply]) or None}
+                           for ply in range(len(moves))])
+
+    def write(self, review):
+        path = os.path.join(self.directory, '{0}-{1}.json'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                                                 self.reviewed))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(review, f, indent=2)
+        os.replace(temp_path, path)
+        return path
+
+    def stats(self):
+        return {'reviewed': self.reviewed, 'queued': self.games.qsize(), 'reused_plies': self.reused_plies,
+                'searched_plies': self.searched_plies}
+
+
+def known_mean(values):
+    """Mean of the values which are not NaN, or None if there are none"""
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else None
+
+
+def nan_to_none(value):
+    return None if np.isnan(value) else float(value)
@@ -0,0 +1,32 @@
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def setup_logging(level='INFO', log_file=None):
+    """Send log records through a queue so the bot loop never blocks on terminal or file I/O.
+    Returns the listener, which should be stopped on exit to flush the queue."""
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def setup_logging_from_config(config):
+    return setup_logging(config.get('logging', 'level', fallback='INFO'),
+                         config.get('logging', 'file', fallback=None) or None)
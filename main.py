@@ -1,5 +1,18 @@
+from configparser import ConfigParser
+
+from board_scheduler import BoardScheduler
 from bot import Bot
+from logging_setup import setup_logging_from_config
 
 if __name__ == '__main__':
-    robot = Bot()
-    robot.run()
+    config = ConfigParser()
+    config.read('config.ini')
+    log_listener = setup_logging_from_config(config)
+    try:
+        if config.getboolean('boards', 'multiple', fallback=False):
+            BoardScheduler().run()
+        else:
+            robot = Bot()
+            robot.run()
+    finally:
+        log_listener.stop()
@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Streaming histogram with logarithmic buckets, so quantiles are kept in constant memory"""
+    # bucket upper bounds grow by this factor, giving quantiles within about 5%
+    GROWTH = 1.05
+    MIN_VALUE = 1e-6
+
+    def __init__(self):
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket_index(self, value):
+        return math.ceil(math.log(max(value, Histogram.MIN_VALUE) / Histogram.MIN_VALUE, Histogram.GROWTH))
+
+    def bucket_bound(self, index):
+        return Histogram.MIN_VALUE * Histogram.GROWTH ** index
+
+    def add(self, value):
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, fraction):
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.bucket_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'min': self.min if self.min is not None else 0.0,
+                'max': self.max if self.max is not None else 0.0,
+                'p50': self.quantile(0.50),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        # callables returning {name: value}, sampled as gauges on every export
+        self.collectors = []
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block in seconds on a monotonic clock and record it in the histogram for name"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    def snapshot(self):
+        gauges = {}
+        for collector in self.collectors:
+            try:
+                for name, value in collector().items():
+                    gauges[name] = value
+            except Exception:
+                logger.exception('Exception collecting metrics')
+        with self.lock:
+            return {'time': time.time(),
+                    'stages': {name: histogram.summary() for name, histogram in self.histograms.items()},
+                    'counters': dict(self.counters),
+                    'gauges': gauges}
+
+    def to_prometheus(self, snapshot, prefix='chess_bot'):
+        lines = []
+        for name, summary in snapshot['stages'].items():
+            metric = f'{prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for quantile in ('p50', 'p95', 'p99'):
+                lines.append(f'{metric}{{quantile="0.{quantile[1:]}"}} {summary[quantile]}')
+            lines.append(f'{metric}_sum {summary["sum"]}')
+            lines.append(f'{metric}_count {summary["count"]}')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+        for name, value in snapshot['gauges'].items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append(f'# TYPE {prefix}_{name} gauge')
+                lines.append(f'{prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Write the metrics to path, as Prometheus text if it ends in .prom and as JSON otherwise"""
+        snapshot = self.snapshot()
+        if path.endswith('.prom'):
+            content = self.to_prometheus(snapshot)
+        else:
+            content = json.dumps(snapshot, indent=2)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.replace(temp_path, path)  # readers never see a half-written file
+
+
+class MetricsExporter:
+    def __init__(self, metrics, path, interval=10):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)  # the bot has no shutdown path, so write the final figures at exit
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.metrics.export(self.path)
+            except Exception:
+                logger.exception('Exception exporting metrics')
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.export(self.path)
@@ -0,0 +1,49 @@
+class MoveLog:
+    """Move list with a rolling hash of every prefix, so two lists can be compared without walking them"""
+    MULTIPLIER = 1000003
+    MASK = (1 << 64) - 1
+
+    def __init__(self, moves=()):
+        self.moves = []
+        self.hashes = []  # hashes[i] covers moves[:i + 1]
+        self.extend(moves)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def prefix_hash(self, length):
+        return self.hashes[length - 1] if length > 0 else 0
+
+    def digest(self):
+        """Identifies the whole list; equal digests mean equal lists"""
+        return len(self.moves), self.prefix_hash(len(self.moves))
+
+    def extend(self, moves):
+        rolling = self.prefix_hash(len(self.moves))
+        for move in moves:
+            rolling = (rolling * MoveLog.MULTIPLIER + hash(move)) & MoveLog.MASK
+            self.moves.append(move)
+            self.hashes.append(rolling)
+
+    def truncate(self, length):
+        del self.moves[length:]
+        del self.hashes[length:]
+
+    def replace(self, ply, moves):
+        """Replace everything from ply onwards with moves"""
+        self.truncate(ply)
+        self.extend(moves)
+
+    def first_difference(self, other):
+        """Ply of the first move where this log and other differ, or None if they are the same"""
+        if self.digest() == other.digest():
+            return None
+        # prefix hashes agree up to the first difference and differ from there on, so binary search for it
+        low, high = 0, min(len(self), len(other))
+        while low < high:
+            middle = (low + high) // 2
+            if self.hashes[middle] == other.hashes[middle]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
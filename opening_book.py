@@ -0,0 +1,60 @@
+import chess
+import chess.engine
+import chess.polyglot
+
+
+class OpeningBook:
+    def __init__(self, books):
+        # Polyglot readers memory-map the book and binary search it, so only the probed entries are read from disk
+        self.readers = [(chess.polyglot.open_reader(path), weight) for path, weight in books]
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Books are listed one per line under [book] files, each optionally followed by a comma and a weight"""
+        books = []
+        for line in config['book']['files'].splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if ',' in line:
+                path, weight = line.rsplit(',', 1)
+                books.append((path.strip(), float(weight)))
+            else:
+                books.append((line, 1.0))
+        return cls(books)
+
+    @staticmethod
+    def reader_has_key(reader, key):
+        index = reader.bisect_key_left(key)
+        return index < len(reader) and reader[index].key == key
+
+    def probe(self, board, key, multipv=1):
+        """Return the book moves for board shaped like engine InfoDicts, or None if it is out of book.
+        key is the zobrist hash of board."""
+        move_weights = {}
+        for reader, book_weight in self.readers:
+            if not OpeningBook.reader_has_key(reader, key):
+                continue
+            entries = list(reader.find_all(board))
+            total = sum(entry.weight for entry in entries)
+            for entry in entries:
+                # normalise so each book contributes according to its configured weight
+                move_weights[entry.move] = move_weights.get(entry.move, 0) + book_weight * entry.weight / total
+
+        if not move_weights:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        ranked = sorted(move_weights.items(), key=lambda item: item[1], reverse=True)[:multipv]
+        return [{'pv': [move],
+                 'score': chess.engine.PovScore(chess.engine.Cp(0), board.turn),
+                 'depth': 0,
+                 'multipv': i + 1,
+                 'book_weight': weight} for i, (move, weight) in enumerate(ranked)]
+
+    def close(self):
+        for reader, _ in self.readers:
+            reader.close()
@@ -0,0 +1,141 @@
+import atexit
+import gzip
+import struct
+import time
+
+from constants import Side
+
+MAGIC = b'CBTRACE\x02'
+
+BOARD = b'B'
+SNAPSHOT = b'S'
+DRAW = b'D'
+
+RECORD_HEADER = struct.Struct('<cd')  # kind, seconds since the recording started
+BOARD_HEADER = struct.Struct('<HHH')  # trace id, board index on its page, window handle length
+SNAPSHOT_HEADER = struct.Struct('<HBBfffHH')  # trace id, present, side, x, y, width, ply, move count
+MOVE_LENGTH = struct.Struct('<B')
+SCRIPT_HEADER = struct.Struct('<HI')  # trace id, script length
+
+
+class TraceEvent:
+    def __init__(self, kind, time, trace_id=None, board_index=None, handle=None, board_present=False,
+                 player=Side.NEITHER, rect=None, moves=None, script=None):
+        self.kind = kind
+        self.time = time
+        self.trace_id = trace_id  # which board of the session, unique across tabs
+        self.board_index = board_index  # which board of its page, in document order
+        self.handle = handle  # the window handle of its tab
+        self.board_present = board_present
+        self.player = player
+        self.rect = rect  # (x, y, width) of the board, or None if it was never reported
+        self.moves = moves  # the whole move list, not just the changed part
+        self.script = script
+
+
+class TraceRecorder:
+    """Writes the page as the bot saw it, and everything it drew, to a gzip compressed binary trace.
+    A snapshot is written only when something in it changed, with the move list as the change since the last one.
+    Each board gets a trace id from add_board, and its snapshots and scripts are written under that id."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start_time = time.monotonic()
+        self.boards = {}  # trace id -> (present, player, rect) and move list last written
+        self.next_id = 0
+        self.snapshots = 0
+        self.scripts = 0
+        atexit.register(self.close)
+
+    def record(self, kind, payload):
+        self.file.write(RECORD_HEADER.pack(kind, time.monotonic() - self.start_time))
+        self.file.write(payload)
+
+    def add_board(self, board_index, handle):
+        """Return a new trace id for the board_index-th board of the tab with window handle handle"""
+        trace_id = self.next_id
+        self.next_id += 1
+        data = (handle or '').encode()
+        self.record(BOARD, BOARD_HEADER.pack(trace_id, board_index, len(data)) + data)
+        return trace_id
+
+    def snapshot(self, trace_id, board_present, player, geometry, moves):
+        rect = (geometry.board_pos.x, geometry.board_pos.y, geometry.board_dim) \
+            if geometry.board_pos is not None else None
+        state = (board_present, player, rect)
+        last_state, last_moves = self.boards.get(trace_id, (None, []))
+        if state == last_state and moves == last_moves:
+            return
+
+        ply = 0
+        while ply < len(moves) and ply < len(last_moves) and moves[ply] == last_moves[ply]:
+            ply += 1
+        changed = [move.encode() for move in moves[ply:]]
+        x, y, width = rect if rect is not None else (0, 0, -1)
+        payload = [SNAPSHOT_HEADER.pack(trace_id, board_present, player.value, x, y, width, ply, len(changed))]
+        for move in changed:
+            payload.append(MOVE_LENGTH.pack(len(move)))
+            payload.append(move)
+        self.record(SNAPSHOT, b''.join(payload))
+        self.boards[trace_id] = (state, list(moves))
+        self.snapshots += 1
+
+    def script(self, trace_id, script):
+        data = script.encode()
+        self.record(DRAW, SCRIPT_HEADER.pack(trace_id, len(data)) + data)
+        self.scripts += 1
+
+    def stats(self):
+        return {'boards': self.next_id, 'snapshots': self.snapshots, 'scripts': self.scripts}
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_exactly(file, size):
+    data = file.read(size)
+    if len(data) < size:
+        raise EOFError('Trace ends in the middle of a record')
+    return data
+
+
+def read_trace(path):
+    """Yield the TraceEvents of a trace in the order they were recorded"""
+    boards = {}  # trace id -> board index and window handle
+    moves = {}  # trace id -> move list so far
+    with gzip.open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a page trace of this version')
+        while True:
+            try:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                kind, event_time = RECORD_HEADER.unpack(header)
+                if kind == BOARD:
+                    trace_id, board_index, length = BOARD_HEADER.unpack(read_exactly(file, BOARD_HEADER.size))
+                    boards[trace_id] = (board_index, read_exactly(file, length).decode())
+                    event = TraceEvent(kind, event_time, trace_id, *boards[trace_id])
+                elif kind == SNAPSHOT:
+                    trace_id, present, side, x, y, width, ply, count = \
+                        SNAPSHOT_HEADER.unpack(read_exactly(file, SNAPSHOT_HEADER.size))
+                    changed = []
+                    for _ in range(count):
+                        length, = MOVE_LENGTH.unpack(read_exactly(file, MOVE_LENGTH.size))
+                        changed.append(read_exactly(file, length).decode())
+                    board_moves = moves[trace_id] = moves.get(trace_id, [])[:ply] + changed
+                    event = TraceEvent(kind, event_time, trace_id, *boards.get(trace_id, (None, None)),
+                                       bool(present), Side(side), (x, y, width) if width >= 0 else None,
+                                       list(board_moves))
+                elif kind == DRAW:
+                    trace_id, length = SCRIPT_HEADER.unpack(read_exactly(file, SCRIPT_HEADER.size))
+                    event = TraceEvent(kind, event_time, trace_id, *boards.get(trace_id, (None, None)),
+                                       script=read_exactly(file, length).decode())
+                else:
+                    raise ValueError(f'Unknown record {kind!r} in {path}')
+            except EOFError:
+                return  # cut off in the middle of a record, e.g. by the bot being killed
+            yield event
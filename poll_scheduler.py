@@ -0,0 +1,78 @@
+import time
+from enum import Enum
+
+
+class PollState(Enum):
+    NO_BOARD = 'no_board'
+    WAITING_FOR_OPPONENT = 'waiting_for_opponent'
+    OUR_MOVE = 'our_move'  # also used when watching a game we are not playing
+    GAME_OVER = 'game_over'
+
+
+# (minimum, maximum) seconds, for configs without a [polling] section
+DEFAULT_INTERVALS = {
+    PollState.NO_BOARD: (0.5, 5),
+    PollState.WAITING_FOR_OPPONENT: (0.5, 4),
+    PollState.OUR_MOVE: (0.1, 1),
+    PollState.GAME_OVER: (1, 10),
+}
+
+
+class PollScheduler:
+    """Decides how long the bot waits for the page before polling again.
+    Each state has its own interval, which doubles up to a maximum while polls find nothing new
+    and drops back as soon as the page changes or the state does."""
+
+    def __init__(self, intervals):
+        self.intervals = intervals  # PollState -> (minimum, maximum) seconds
+        self.state = PollState.NO_BOARD
+        self.interval = intervals[self.state][0]
+        self.state_start_time = time.monotonic()
+
+        self.time_in_state = {state: 0.0 for state in PollState}
+        self.wakeups = {state: 0 for state in PollState}
+        self.change_wakeups = {state: 0 for state in PollState}
+
+    @classmethod
+    def from_config(cls, config):
+        intervals = {}
+        for state, (minimum, maximum) in DEFAULT_INTERVALS.items():
+            intervals[state] = (config.getfloat('polling', f'{state.value}_interval', fallback=minimum),
+                                config.getfloat('polling', f'{state.value}_max_interval', fallback=maximum))
+        return cls(intervals)
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+        now = time.monotonic()
+        self.time_in_state[self.state] += now - self.state_start_time
+        self.state_start_time = now
+        self.state = state
+        self.interval = self.intervals[state][0]
+
+    def timeout(self, urgent=False):
+        """Seconds to wait for a page change. urgent polls at the state's minimum interval,
+        e.g. while a search is running whose result should be drawn as soon as it is ready"""
+        return self.intervals[self.state][0] if urgent else self.interval
+
+    def woke(self, changed):
+        """Record the end of a wait, which either saw the page change or timed out"""
+        self.wakeups[self.state] += 1
+        if changed:
+            self.change_wakeups[self.state] += 1
+            self.interval = self.intervals[self.state][0]
+        else:
+            self.interval = min(self.interval * 2, self.intervals[self.state][1])
+
+    def stats(self):
+        stats = {}
+        now = time.monotonic()
+        for state in PollState:
+            seconds = self.time_in_state[state]
+            if state == self.state:
+                seconds += now - self.state_start_time
+            stats[f'{state.value}_seconds'] = seconds
+            stats[f'{state.value}_wakeups'] = self.wakeups[state]
+            stats[f'{state.value}_change_wakeups'] = self.change_wakeups[state]
+        stats['interval'] = self.interval
+        return stats
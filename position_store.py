@@ -0,0 +1,210 @@
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from serialization import infos_from_list, infos_to_list
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS positions (
+    key INTEGER NOT NULL,
+    engine TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    multipv INTEGER NOT NULL,
+    turn INTEGER NOT NULL,
+    infos TEXT NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (key, engine)
+);
+CREATE INDEX IF NOT EXISTS positions_used ON positions (used);
+'''
+
+# keeps a deeper search already on disk rather than overwriting it with a shallower one
+UPSERT = '''
+INSERT INTO positions (key, engine, depth, multipv, turn, infos, used) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (key, engine) DO UPDATE SET
+    depth = excluded.depth, multipv = excluded.multipv, turn = excluded.turn, infos = excluded.infos,
+    used = excluded.used
+WHERE excluded.depth > positions.depth OR excluded.depth = positions.depth AND excluded.multipv >= positions.multipv
+'''
+
+
+def signed_key(key):
+    """Zobrist hashes are unsigned 64 bit, SQLite integers are signed"""
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+class StoredEvaluation:
+    def __init__(self, infos, depth, multipv, engine_name):
+        self.infos = infos
+        self.depth = depth
+        self.multipv = multipv
+        self.engine_name = engine_name
+
+
+class PositionStore:
+    """Evaluations kept between sessions in an SQLite file, one row per position and engine.
+    Lookups are point queries on the calling thread; writes are batched on a background thread,
+    which also evicts the least recently used rows once the file holds more than max_entries."""
+
+    def __init__(self, path, max_entries=1000000, flush_interval=1.0, compact_interval=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+
+        self.connection = self.connect(create=True)
+        self.read_lock = threading.Lock()
+
+        self.condition = threading.Condition()
+        self.pending = {}  # (key, engine) -> row waiting to be written
+        self.touched = {}  # (key, engine) -> time it was last read
+        self.closing = False
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # the bot has no shutdown path, so flush what is pending at exit
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['position_store']['file'],
+                   max_entries=config['position_store'].getint('max_entries'),
+                   flush_interval=config['position_store'].getfloat('flush_interval'),
+                   compact_interval=config['position_store'].getfloat('compact_interval'))
+
+    def connect(self, create=False):
+        connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        if create:
+            # incremental vacuum has to be chosen before the switch to WAL writes the header and before the first
+            # table exists. A file created without it is converted once, by rebuilding it
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            if connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                logger.info('Converting %s to incremental vacuum', self.path)
+                connection.execute('VACUUM')
+        # readers are not blocked by the writer, and several bots can share the file
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        if create:
+            connection.executescript(SCHEMA)
+        return connection
+
+    def get(self, key, depth, multipv, engine_name=None):
+        """Return the stored evaluation of key if it was searched at least as deep and wide as requested.
+        Without engine_name, the deepest evaluation by any engine is used"""
+        row = None
+        if engine_name is not None:
+            with self.condition:
+                queued = self.pending.get((key, engine_name))
+            if queued is not None:
+                row = queued[1:6]  # not written yet, but already known
+        if row is None:
+            if engine_name is not None:
+                query = ('SELECT engine, depth, multipv, turn, infos FROM positions WHERE key = ? AND engine = ?',
+                         (signed_key(key), engine_name))
+            else:
+                query = ('SELECT engine, depth, multipv, turn, infos FROM positions WHERE key = ? '
+                         'ORDER BY depth DESC, multipv DESC LIMIT 1', (signed_key(key),))
+            with self.read_lock:
+                row = self.connection.execute(*query).fetchone()
+        if row is None or row[1] < depth or row[2] < multipv:
+            self.misses += 1
+            return None
+
+        engine, row_depth, row_multipv, turn, infos = row
+        self.hits += 1
+        with self.condition:
+            self.touched[(key, engine)] = time.time()
+        return StoredEvaluation(infos_from_list(json.loads(infos), bool(turn)), row_depth, row_multipv,
+                                engine if engine else None)
+
+    def recent(self, count):
+        """The count most recently used evaluations as (zobrist hash, StoredEvaluation), most recent first"""
+        with self.read_lock:
+            rows = self.connection.execute('SELECT key, engine, depth, multipv, turn, infos FROM positions '
+                                           'ORDER BY used DESC LIMIT ?', (count,)).fetchall()
+        for key, engine, depth, multipv, turn, infos in rows:
+            yield key & ((1 << 64) - 1), StoredEvaluation(infos_from_list(json.loads(infos), bool(turn)), depth,
+                                                         multipv, engine if engine else None)
+
+    def put(self, key, infos, depth, multipv, engine_name):
+        if not infos or 'score' not in infos[0]:
+            return  # nothing to rebuild the side to move from
+        engine_key = engine_name if engine_name is not None else ''
+        row = (key, engine_key, depth, multipv, int(infos[0]['score'].turn), json.dumps(infos_to_list(infos)),
+               time.time())
+        with self.condition:
+            queued = self.pending.get((key, engine_key))
+            if queued is None or (depth, multipv) >= (queued[2], queued[3]):
+                self.pending[(key, engine_key)] = row
+
+    def run(self):
+        # SQLite connections are best kept to one thread each
+        connection = self.connect()
+        self.compact(connection)
+        next_compaction = time.monotonic() + self.compact_interval
+        while True:
+            with self.condition:
+                if not self.closing:
+                    self.condition.wait(self.flush_interval)
+                pending, self.pending = self.pending, {}
+                touched, self.touched = self.touched, {}
+                closing = self.closing
+            try:
+                self.write(connection, pending, touched)
+                if time.monotonic() >= next_compaction:
+                    self.compact(connection)
+                    next_compaction = time.monotonic() + self.compact_interval
+            except sqlite3.Error as e:
+                logger.error('Exception writing position store: %s', e)
+            if closing:
+                connection.close()
+                return
+
+    def write(self, connection, pending, touched):
+        if not pending and not touched:
+            return
+        with connection:
+            connection.executemany(UPSERT, [(signed_key(row[0]),) + row[1:] for row in pending.values()])
+            connection.executemany('UPDATE positions SET used = ? WHERE key = ? AND engine = ?',
+                                   [(used, signed_key(key), engine) for (key, engine), used in touched.items()])
+        self.writes += len(pending)
+
+    def compact(self, connection):
+        """Evict the least recently used rows beyond max_entries and give their pages back to the file system"""
+        count = connection.execute('SELECT COUNT(*) FROM positions').fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # down to a little under the cap, so the next compaction is not due straight away
+        excess = count - self.max_entries * 9 // 10
+        with connection:
+            connection.execute('DELETE FROM positions WHERE rowid IN '
+                               '(SELECT rowid FROM positions ORDER BY used LIMIT ?)', (excess,))
+        # run as a script, which steps it to the end; execute would free a single page
+        connection.executescript('PRAGMA incremental_vacuum')
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.evictions += excess
+        logger.info('Evicted %d positions from %s', excess, self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'writes': self.writes, 'evictions': self.evictions, 'pending': len(self.pending)}
+
+    def close(self):
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        with self.read_lock:
+            self.connection.close()
@@ -0,0 +1,117 @@
+import argparse
+import collections
+import json
+import time
+
+from benchmark import Benchmark, FakeWebDriver, print_report
+from constants import Side
+from page_trace import BOARD, DRAW, SNAPSHOT, read_trace
+
+ORIENTATIONS = {Side.WHITE: 'white', Side.BLACK: 'black', Side.NEITHER: 'none'}
+
+
+class ReplayWebDriver(FakeWebDriver):
+    """Serves the page states of a recorded trace on a clock running speed times as fast as the recording.
+    With a speed of 0, each wait of the bot moves straight on to the next page state."""
+
+    def __init__(self, events, speed=1.0, latency=0.0):
+        super().__init__(latency=latency)
+        self.events = collections.deque(events)
+        self.speed = speed
+        self.start_time = None
+        self.board_present = False
+        self.page_loads = 0
+        self.draw_calls = 0
+
+    def finished(self):
+        return not self.events
+
+    def trace_time(self):
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        return (time.monotonic() - self.start_time) * self.speed
+
+    def apply(self, event):
+        if event.board_present and not self.board_present:
+            # a board appearing means a new page, whose move log the bot has to read from the start
+            self.page_loads += 1
+            self.log_id = f'replay{self.page_loads}'
+            self.moves = []
+            self.log_seq = 0
+            self.log_events = {}
+        self.board_present = event.board_present
+        self.orientation = ORIENTATIONS[event.player]
+        if event.rect is not None:
+            self.set_board_rect(event.rect)
+        self.set_page_moves(event.moves)
+
+    def advance(self):
+        if self.speed <= 0:
+            if self.events:
+                self.apply(self.events.popleft())
+            return
+        now = self.trace_time()
+        while self.events and self.events[0].time <= now:
+            self.apply(self.events.popleft())
+
+    def execute_script(self, script, *args):
+        if self.interface is None or script != self.interface.snapshot_script:
+            self.draw_calls += 1
+        return super().execute_script(script, *args)
+
+    def execute_async_script(self, script, *args):
+        self.round_trip()
+        self.async_script_calls += 1
+        versions, timeout_ms = args
+        self.advance()
+        if not self.changed_boards(versions) and self.speed > 0 and self.events:
+            # sleep until the next page state or the timeout, like the page-side wait
+            delay = min(timeout_ms / 1000, (self.events[0].time - self.trace_time()) / self.speed)
+            if delay > 0:
+                time.sleep(delay)
+            self.advance()
+        return self.changed_boards(versions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded page trace through the bot with its real engines')
+    parser.add_argument('trace', help='trace written with [trace] file set')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='how many times faster than recorded; 0 for as fast as the bot can poll')
+    parser.add_argument('--board', type=int, default=0,
+                        help='trace id of the recorded board to replay; 0 is the first board of the tab the bot started in')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per WebDriver round trip')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    events = list(read_trace(args.trace))
+    for event in events:
+        if event.kind == BOARD:
+            print('Board {0}: board {1} in window {2}'.format(event.trace_id, event.board_index, event.handle))
+    page_states = [event for event in events if event.kind == SNAPSHOT and event.trace_id == args.board]
+    driver = ReplayWebDriver(page_states, args.speed, args.latency)
+    benchmark = Benchmark(args.config, args.latency, idle_polls=0, driver=driver)
+    start_time = time.monotonic()
+    try:
+        while not driver.finished() or benchmark.bot.pending_eval is not None:
+            benchmark.step()
+    finally:
+        benchmark.bot.engine_manager.quit()
+
+    report = benchmark.report()
+    report['replay'] = {'page_states': len(page_states),
+                        'recorded_scripts': sum(1 for event in events
+                                                if event.kind == DRAW and event.trace_id == args.board),
+                        'replayed_scripts': driver.draw_calls,
+                        'trace_seconds': events[-1].time if events else 0.0,
+                        'replay_seconds': time.monotonic() - start_time}
+    print_report(report)
+    print('Replay: {0}'.format(report['replay']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,15 @@ from vector_2d import Vector2D
 
 
 class SeleniumCanvas:
-    def __init__(self, driver):
+    def __init__(self, driver, recorder=None, trace_id=None):
         self.driver = driver
+        self.recorder = recorder  # a TraceRecorder given every script sent to the page
+        self.trace_id = trace_id  # the id the recorder gave the board drawn on
         # self.canvases = []
         self.contexts = {}
+        # scripts recorded for the frame being drawn, or None when drawing immediately
+        self.frame = None
+        self.last_frame_script = None
 
     def create_canvas_context(self, canvas, context):
         script = "window.{0} = document.createElement('canvas');" \
@@ -42,7 +47,8 @@ class SeleniumCanvas:
                                             context.globalAlpha,
                                             context.font)
 
-        self.driver.execute_script(script)
+        self.send(script)
+        self.invalidate_frame()
 
     def add_canvas_context(self, canvas_name, context_name):
         new_canvas = JSCanvas(canvas_name)
@@ -52,6 +58,40 @@ class SeleniumCanvas:
         # self.contexts.append(new_context)
         self.contexts[context_name] = new_context
 
+    def execute(self, script):
+        if self.frame is not None:
+            self.frame.append(script)
+        else:
+            self.send(script)
+
+    def send(self, script):
+        if self.recorder is not None:
+            self.recorder.script(self.trace_id, script)
+        self.driver.execute_script(script)
+
+    def begin_frame(self):
+        """Record draw and style operations until end_frame instead of sending each one to the browser"""
+        self.frame = []
+
+    def end_frame(self):
+        """Send the recorded frame in a single script, unless it is identical to the frame already on screen"""
+        script = ''.join(self.frame)
+        self.frame = None
+        if script == self.last_frame_script:
+            return False
+        self.last_frame_script = None
+        self.send(script)
+        self.last_frame_script = script
+        return True
+
+    def discard_frame(self):
+        self.frame = None
+        self.invalidate_frame()
+
+    def invalidate_frame(self):
+        # forces the next frame to be drawn, e.g. when the canvas may have been removed from the page
+        self.last_frame_script = None
+
     def check_missing_contexts(self):
         missing = []
 
@@ -67,7 +107,7 @@ class SeleniumCanvas:
     def clear_context(self, context_name):
         context = self.contexts[context_name]
         script = "{0}.clearRect(0, 0, {1}.width, {1}.height);".format(context.name, context.canvas.name)
-        self.driver.execute_script(script)
+        self.execute(script)
 
     def set_styles(self, context_name, visibility=None, stroke_style=None, fill_style=None, global_alpha=None, font=None):
         context = self.contexts[context_name]
@@ -85,12 +125,12 @@ class SeleniumCanvas:
         if font is not None:
             script += "{0}.font = {1};".format(context.name, font)
 
-        self.driver.execute_script(script)
+        self.execute(script)
 
     def draw_text(self, context_name, text, pos):
         context = self.contexts[context_name]
         script = "{0}.fillText({1}, {2}, {3});".format(context.name, text, pos.x, pos.y)
-        self.driver.execute_script(script)
+        self.execute(script)
 
     def draw_centered_text(self, context_name, text, pos, stroke_style="'black'", fill_style=None):
         context = self.contexts[context_name]
@@ -105,12 +145,12 @@ class SeleniumCanvas:
             self.set_styles(context.name, fill_style=fill_style)
         script += "{0}.fillText('{1}', {2}, {3});".format(context.name, text, pos.x, pos.y)
 
-        self.driver.execute_script(script)
+        self.execute(script)
 
     def draw_filled_rect(self, context_name, pos, dim):
         context = self.contexts[context_name]
         script = "{0}.fillRect({1}, {2}, {3}, {4});".format(context.name, pos.x, pos.y, dim.x, dim.y)
-        self.driver.execute_script(script)
+        self.execute(script)
 
     def draw_arrow(self, context_name, from_pos, to_pos):
         context = self.contexts[context_name]
@@ -142,4 +182,4 @@ class SeleniumCanvas:
                                       off_to.x,
                                       off_to.y)
 
-        self.driver.execute_script(script)
+        self.execute(script)
@@ -1,16 +1,50 @@
+import logging
+import math
 import time
 
 import chess.engine
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, TimeoutException
 
-from constants import Side
+from board_geometry import BoardGeometry
+from constants import MAX_PAGE_WAIT, SCRIPT_TIMEOUT, Side
+from move_log import MoveLog
 from selenium_canvas import SeleniumCanvas
 from vector_2d import Vector2D
 
+logger = logging.getLogger(__name__)
+
+
+class PageSnapshot:
+    ORIENTATIONS = {'white': Side.WHITE, 'black': Side.BLACK}
+
+    def __init__(self, board_present, board_pos=None, board_dim=None, player=Side.NEITHER, move_list=None,
+                 geometry=None):
+        self.board_present = board_present
+        # board rect, only reported when the page-side geometry counter has moved on
+        self.board_pos = board_pos
+        self.board_dim = board_dim
+        self.player = player
+        self.move_list = move_list if move_list is not None else []
+        self.geometry = geometry
+
+    @classmethod
+    def from_script_result(cls, result, move_list):
+        if not result or not result.get('boardPresent'):
+            return cls(False)
+        return cls(True,
+                   board_pos=Vector2D(result['x'], result['y']) if 'x' in result else None,
+                   board_dim=result.get('width'),
+                   player=PageSnapshot.ORIENTATIONS.get(result['orientation'], Side.NEITHER),
+                   move_list=move_list,
+                   geometry=result.get('geometry'))
+
 
 class SeleniumChess:
-    def __init__(self, driver):
+    # number of move list changes the page keeps for the bot to catch up on
+    MOVE_LOG_CAPACITY = 256
+
+    def __init__(self, driver, board_index=0, recorder=None):
         self.patterns = {
             'chessboard': 'chess-board',
             'bottom_player_white': '.clock-white.clock-bottom',
@@ -20,14 +54,29 @@ class SeleniumChess:
         }
 
         self.driver = driver
+        # which chess-board element of the page this instance tracks, in document order
+        self.board_index = board_index
 
-        self.graphics = SeleniumCanvas(self.driver)
+        self.driver.set_script_timeout(SCRIPT_TIMEOUT)
+        self.recorder = recorder  # a TraceRecorder given every snapshot of the page
+        # the same board index is used by every tab, so the recorder tells boards apart by a trace id of their own
+        self.trace_id = recorder.add_board(board_index, self.driver.current_window_handle) \
+            if recorder is not None else None
+        self.graphics = SeleniumCanvas(self.driver, recorder, self.trace_id)
 
         self.board = None
         self.chains = None
-        self.board_dim = None
-        self.piece_dim = None
-        self.board_pos = None
+        self.geometry = BoardGeometry()
+
+        # move list as last reported by the page-side move log
+        self.move_log = MoveLog()
+        self.move_log_id = None
+        self.move_log_seq = 0
+
+        self.move_log_script = self.make_move_log_script()
+        self.snapshot_script = self.make_snapshot_script()
+        self.wait_for_moves_script = self.make_wait_for_moves_script()
+        self.count_boards_script = self.make_count_boards_script()
 
     def try_set_elements(self):
         try:
@@ -35,15 +84,195 @@ class SeleniumChess:
         except NoSuchElementException:
             return False  # All elements must be found. No point in continuing if even one is missing
         except Exception as e:
-            print('Exception in getting chessboard element: {0}'.format(e))
+            logger.warning('Exception in getting chessboard element: %s', e)
             return False
         return True
 
+    def make_move_log_script(self):
+        """Install a MutationObserver which records every move list change of the board in a ring buffer of events.
+        Expects the board element in board; each board of the page gets its own log in window.chessBotMoveLogs"""
+        chessboard = self.patterns['chessboard']
+        move = self.patterns['move']
+        script = ""
+        script += "if (window.chessBotMoveLogs === undefined) { window.chessBotMoveLogs = {}; }"
+        script += "if (chessBotMoveLogs[arguments[0]] === undefined || chessBotMoveLogs[arguments[0]].board !== board) {"
+        script += "const previous = chessBotMoveLogs[arguments[0]];"
+        script += "if (previous !== undefined) {"
+        script += "previous.observer.disconnect();"
+        script += "previous.resizeObserver.disconnect();"
+        script += "window.removeEventListener('scroll', previous.moveGeometry);"
+        script += "window.removeEventListener('resize', previous.moveGeometry);"
+        script += "}"
+        # the board's moves and clocks are looked up in the largest element containing no other board
+        script += "let root = board;"
+        script += f"while (root.parentElement !== null && " \
+                  f"root.parentElement.querySelectorAll('{chessboard}').length === 1) {{"
+        script += "root = root.parentElement;"
+        script += "}"
+        script += f"const log = {{id: String(Math.random()), seq: 0, capacity: {SeleniumChess.MOVE_LOG_CAPACITY}, " \
+                  "events: [], moves: [], waiters: [], board: board, root: root, geometry: 0};"
+        # counts changes to the board rect, so the bot only rebuilds its square positions when it has moved
+        script += "log.moveGeometry = () => { log.geometry += 1; };"
+        script += "log.resizeObserver = new ResizeObserver(log.moveGeometry);"
+        script += "log.resizeObserver.observe(board);"
+        script += "window.addEventListener('scroll', log.moveGeometry, {passive: true});"
+        script += "window.addEventListener('resize', log.moveGeometry);"
+        script += "log.record = () => {"
+        script += f"const moves = [...log.root.querySelectorAll('{move}')].map((move) => move.innerText);"
+        script += "let ply = 0;"
+        script += "while (ply < moves.length && ply < log.moves.length && moves[ply] === log.moves[ply]) { ply++; }"
+        script += "if (ply === moves.length && ply === log.moves.length) { return; }"
+        script += "log.seq += 1;"
+        script += "log.events[log.seq % log.capacity] = {ply: ply, moves: moves.slice(ply)};"
+        script += "log.moves = moves;"
+        script += "const waiters = log.waiters;"
+        script += "log.waiters = [];"
+        script += "waiters.forEach((wake) => wake());"
+        script += "};"
+        script += "log.since = (id, seq) => {"
+        script += "if (id !== log.id || seq > log.seq || log.seq - seq > log.capacity) {"
+        script += "return {id: log.id, seq: log.seq, reset: true, moves: log.moves};"
+        script += "}"
+        script += "const events = [];"
+        script += "for (let i = seq + 1; i <= log.seq; i++) { events.push(log.events[i % log.capacity]); }"
+        script += "return {id: log.id, seq: log.seq, reset: false, events: events};"
+        script += "};"
+        script += f"const isMoveNode = (node) => node.nodeType === 1 && " \
+                  f"(node.matches('{move}') || node.querySelector('{move}') !== null);"
+        script += "const isRelevant = (mutation) => {"
+        script += "const target = mutation.target.nodeType === 1 ? mutation.target : mutation.target.parentElement;"
+        script += f"if (target !== null && target.closest('{move}') !== null) {{ return true; }}"
+        script += "return [...mutation.addedNodes, ...mutation.removedNodes].some(isMoveNode);"
+        script += "};"
+        script += "log.observer = new MutationObserver((mutations) => {"
+        script += "if (mutations.some(isRelevant)) { log.record(); }"
+        script += "});"
+        script += "log.observer.observe(root, {childList: true, subtree: true, characterData: true});"
+        script += "log.record();"
+        script += "chessBotMoveLogs[arguments[0]] = log;"
+        # anyone waiting on the replaced board sees a new log id
+        script += "if (previous !== undefined) { previous.waiters.forEach((wake) => wake()); }"
+        script += "}"
+        return script
+
+    def make_snapshot_script(self):
+        script = ""
+        script += f"const board = document.querySelectorAll('{self.patterns['chessboard']}')[arguments[0]];"
+        script += "if (board === undefined) { return {boardPresent: false}; }"
+        script += self.move_log_script
+        script += "const log = chessBotMoveLogs[arguments[0]];"
+        script += "let orientation = 'neither';"
+        script += f"if (log.root.querySelector('{self.patterns['bottom_player_white']}') !== null) {{"
+        script += "orientation = 'white';"
+        script += f"}} else if (log.root.querySelector('{self.patterns['bottom_player_black']}') !== null) {{"
+        script += "orientation = 'black';"
+        script += "}"
+        script += "const result = {boardPresent: true, orientation: orientation, geometry: log.geometry, " \
+                  "moveLog: log.since(arguments[1], arguments[2])};"
+        script += "if (log.id !== arguments[1] || log.geometry !== arguments[3]) {"
+        script += "const rect = board.getBoundingClientRect();"
+        script += "result.x = rect.left + window.scrollX;"
+        script += "result.y = rect.top + window.scrollY;"
+        script += "result.width = rect.width;"
+        script += "}"
+        script += "return result;"
+        return script
+
+    def make_wait_for_moves_script(self):
+        """Wait on the move logs of several boards in the tab, given as [board index, log id, seq] versions.
+        Calls back with the indices of the boards that changed, or null if none of their logs is installed"""
+        script = ""
+        script += "const callback = arguments[arguments.length - 1];"
+        script += "const versions = arguments[0];"
+        script += "const logs = window.chessBotMoveLogs === undefined ? {} : window.chessBotMoveLogs;"
+        script += "const waiting = versions.filter(([index]) => logs[index] !== undefined);"
+        script += "if (waiting.length === 0) { callback(null); return; }"
+        script += "const changed = () => waiting.filter(([index, id, seq]) => " \
+                  "logs[index].id !== id || logs[index].seq !== seq).map(([index]) => index);"
+        script += "if (changed().length > 0) { callback(changed()); return; }"
+        script += "let timer = null;"
+        script += "let done = false;"
+        script += "const finish = (result) => {"
+        script += "if (done) { return; }"
+        script += "done = true;"
+        script += "clearTimeout(timer);"
+        script += "waiting.forEach(([index]) => { logs[index].waiters = logs[index].waiters.filter(" \
+                  "(waiter) => waiter !== wake); });"
+        script += "callback(result);"
+        script += "};"
+        script += "const wake = () => finish(changed());"
+        script += "timer = setTimeout(() => finish([]), arguments[1]);"
+        script += "waiting.forEach(([index]) => logs[index].waiters.push(wake));"
+        return script
+
+    def make_count_boards_script(self):
+        return f"return document.querySelectorAll('{self.patterns['chessboard']}').length;"
+
+    def apply_move_log(self, move_log):
+        if move_log['reset']:
+            self.move_log.replace(0, move_log['moves'])
+            # a new move log means the page was reloaded, taking the overlay canvas with it
+            self.graphics.invalidate_frame()
+        else:
+            for event in move_log['events']:
+                self.move_log.replace(event['ply'], event['moves'])
+        self.move_log_id = move_log['id']
+        self.move_log_seq = move_log['seq']
+
+    def take_snapshot(self):
+        """Read the orientation, move list changes and, if it has changed, the board rect
+        in a single WebDriver round trip"""
+        geometry_counter = self.geometry.version[1] if self.geometry.version is not None else None
+        result = self.driver.execute_script(self.snapshot_script, self.board_index, self.move_log_id,
+                                            self.move_log_seq, geometry_counter)
+        snapshot = PageSnapshot.from_script_result(result, self.move_log.moves)
+        if snapshot.board_present:
+            self.apply_move_log(result['moveLog'])
+            if snapshot.board_dim is not None:
+                self.geometry.update((self.move_log_id, snapshot.geometry), snapshot.board_pos.x,
+                                     snapshot.board_pos.y, snapshot.board_dim)
+        if self.recorder is not None:
+            self.recorder.snapshot(self.trace_id, snapshot.board_present, snapshot.player, self.geometry,
+                                   self.move_log.moves)
+        return snapshot
+
+    def wait_for_changes(self, interfaces, timeout):
+        """Block until the move list of any of the boards tracked by interfaces, all in the current tab, changes.
+        Returns the board indices that changed, empty on timeout, or None if none of their move logs is installed"""
+        versions = [[interface.board_index, interface.move_log_id, interface.move_log_seq] for interface in interfaces]
+        # a longer wait is split up, since WebDriver abandons a script that runs past SCRIPT_TIMEOUT
+        waits = max(1, math.ceil(timeout / MAX_PAGE_WAIT))
+        for _ in range(waits):
+            try:
+                changed = self.driver.execute_async_script(self.wait_for_moves_script, versions,
+                                                           int(timeout / waits * 1000))
+            except TimeoutException:
+                return set()
+            if changed is None:
+                return None
+            if changed:
+                break
+        return set(changed)
+
+    def wait_for_moves(self, timeout):
+        """Block until the page reports a move list change or the timeout expires. Returns True on a change"""
+        changed = self.wait_for_changes([self], timeout)
+        if changed is None:  # move log is not installed on this page yet
+            time.sleep(timeout)
+            return False
+        return len(changed) > 0
+
+    def count_boards(self):
+        return self.driver.execute_script(self.count_boards_script)
+
+    def apply_snapshot(self, snapshot):
+        # the board geometry was already brought up to date by take_snapshot
+        self.chains = webdriver.ActionChains(self.driver)
+
     def update_variables(self):
         self.chains = webdriver.ActionChains(self.driver)
-        self.board_dim = self.board.size.get('width')  # Board is square; either dimension will do
-        self.piece_dim = self.board_dim // 8
-        self.board_pos = Vector2D(self.board.location.get('x'), self.board.location.get('y'))
+        self.geometry.update(None, self.board.location.get('x'), self.board.location.get('y'),
+                             self.board.size.get('width'))
 
     def find_player_colour(self):
         try:
@@ -61,7 +290,7 @@ class SeleniumChess:
             selected_move = self.driver.find_element_by_css_selector(self.patterns["selected_move"])
             return selected_move.text
         except NoSuchElementException:
-            print('Latest move not found')
+            logger.debug('Latest move not found')
         return None
 
     def get_move_list(self):
@@ -78,57 +307,27 @@ class SeleniumChess:
             return self.get_move_list()
 
     def notation_to_pos(self, ply, bottom_color):
-        if bottom_color == Side.WHITE:
-            pos = Vector2D(self.piece_dim * (ord(ply[0]) - 97), self.board_dim - self.piece_dim * int(ply[1]))
-        elif bottom_color == Side.BLACK:
-            pos = Vector2D(self.piece_dim * (7 - (ord(ply[0]) - 97)),
-                           self.board_dim - self.piece_dim * (9 - int(ply[1])))
-        else:
-            print('Side to move should not be Side.NEITHER')
+        if bottom_color == Side.NEITHER:
+            logger.warning('Side to move should not be Side.NEITHER')
             return
-        pos.x += self.board_pos.x
-        pos.y += self.board_pos.y
-        return pos
+        corner = self.geometry.corner(chess.parse_square(ply[:2]), bottom_color)
+        return Vector2D(corner.x, corner.y)
 
     def draw_move_squares(self, context_name, move, bottom_color):
-        move_uci_string = move.uci()
-        start_ply = move_uci_string[:2]
-        end_ply = move_uci_string[2:4]
-        first_pos = self.notation_to_pos(start_ply, bottom_color)
-        second_pos = self.notation_to_pos(end_ply, bottom_color)
-        dims = Vector2D(self.piece_dim, self.piece_dim)
         self.graphics.set_styles(context_name, visibility="'visible'")
-        self.graphics.draw_filled_rect(context_name, first_pos, dims)
-        self.graphics.draw_filled_rect(context_name, second_pos, dims)
+        self.graphics.draw_filled_rect(context_name, self.geometry.corner(move.from_square, bottom_color),
+                                       self.geometry.square_dims)
+        self.graphics.draw_filled_rect(context_name, self.geometry.corner(move.to_square, bottom_color),
+                                       self.geometry.square_dims)
 
     def draw_move_arrows(self, context_name, move, bottom_color):
-        move_uci_string = move.uci()
-        center_offset = self.piece_dim // 2
-        start_ply = move_uci_string[:2]
-        end_ply = move_uci_string[2:4]
-        first_pos = self.notation_to_pos(start_ply, bottom_color)
-        first_pos.x += center_offset
-        first_pos.y += center_offset
-        second_pos = self.notation_to_pos(end_ply, bottom_color)
-        second_pos.x += center_offset
-        second_pos.y += center_offset
         self.graphics.set_styles(context_name, visibility="'visible'")
-        self.graphics.draw_arrow(context_name, first_pos, second_pos)
+        self.graphics.draw_arrow(context_name, self.geometry.centre(move.from_square, bottom_color),
+                                 self.geometry.centre(move.to_square, bottom_color))
 
     def get_move_text_pos(self, move, bottom_color):
-        move_uci_string = move.uci()
-        center_offset = self.piece_dim // 2
-        start_ply = move_uci_string[:2]
-        end_ply = move_uci_string[2:4]
-        first_pos = self.notation_to_pos(start_ply, bottom_color)
-        first_pos.x += center_offset
-        first_pos.y += center_offset
-        second_pos = self.notation_to_pos(end_ply, bottom_color)
-        second_pos.x += center_offset
-        second_pos.y += center_offset
-        text_pos = Vector2D((first_pos.x + second_pos.x) / 2, (first_pos.y + second_pos.y) / 2)
-        return text_pos
+        return self.geometry.label_anchor(move, bottom_color)
 
     def draw_move_text(self, context_name, move, text, bottom_color, fill_style):
         text_pos = self.get_move_text_pos(move, bottom_color)
-        self.graphics.draw_centered_text(context_name, text, text_pos, fill_style=fill_style)
\ No newline at end of file
+        self.graphics.draw_centered_text(context_name, text, text_pos, fill_style=fill_style)
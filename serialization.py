@@ -0,0 +1,42 @@
+import chess
+import chess.engine
+
+
+def score_to_dict(pov_score):
+    """Scores are stored from white's point of view"""
+    white = pov_score.white()
+    if white.is_mate():
+        return {'mate': white.mate()}
+    return {'cp': white.score()}
+
+
+def score_from_dict(data, turn):
+    score = chess.engine.Mate(data['mate']) if 'mate' in data else chess.engine.Cp(data['cp'])
+    return chess.engine.PovScore(score if turn == chess.WHITE else -score, turn)
+
+
+def info_to_dict(info):
+    data = {'pv': [move.uci() for move in info.get('pv', [])]}
+    if 'score' in info:
+        data['score'] = score_to_dict(info['score'])
+    for key in ('depth', 'seldepth', 'multipv', 'nodes', 'time', 'book_weight'):
+        if key in info:
+            data[key] = info[key]
+    return data
+
+
+def info_from_dict(data, turn):
+    """Rebuild an engine InfoDict for a position with turn to move"""
+    info = {key: value for key, value in data.items() if key not in ('pv', 'score')}
+    info['pv'] = [chess.Move.from_uci(move) for move in data['pv']]
+    if 'score' in data:
+        info['score'] = score_from_dict(data['score'], turn)
+    return info
+
+
+def infos_to_list(infos):
+    return [info_to_dict(info) for info in infos]
+
+
+def infos_from_list(data, turn):
+    return [info_from_dict(info, turn) for info in data]
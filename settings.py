@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+from configparser import ConfigParser
+from dataclasses import dataclass
+
+from engine_config import strength_options
+
+logger = logging.getLogger(__name__)
+
+DRAW_TYPES = ('arrow', 'square')
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The settings read on every poll, parsed and checked once per version of the config file.
+    Everything else in the config is read at startup and needs a restart to change."""
+    search_depth: int
+    use_multipv: bool
+    multipv_count: int
+    evaluation_tries: int
+    elo: int
+    draw_type: str
+    draw_wdl: bool
+
+    @classmethod
+    def from_config(cls, config):
+        settings = cls(search_depth=config['engine'].getint('search_depth'),
+                       use_multipv=config['engine'].getboolean('use_multipv'),
+                       multipv_count=config['engine'].getint('multipv_count'),
+                       evaluation_tries=config['engine'].getint('evaluation_tries'),
+                       elo=config['engine'].getint('elo'),
+                       draw_type=config['interface']['draw_type'],
+                       draw_wdl=config['interface'].getboolean('draw_wdl'))
+        settings.validate()
+        return settings
+
+    def validate(self):
+        if self.search_depth < 1:
+            raise ValueError(f'search_depth must be at least 1, not {self.search_depth}')
+        if self.multipv_count < 1:
+            raise ValueError(f'multipv_count must be at least 1, not {self.multipv_count}')
+        if self.evaluation_tries < 0:
+            raise ValueError(f'evaluation_tries cannot be negative, not {self.evaluation_tries}')
+        if self.draw_type not in DRAW_TYPES:
+            raise ValueError(f'draw_type must be one of {", ".join(DRAW_TYPES)}, not {self.draw_type}')
+
+    def multipv(self, available_options=None):
+        """Number of lines to search for, on an engine with available_options if given"""
+        if not self.use_multipv or available_options is not None and 'MultiPV' not in available_options:
+            return 1
+        return self.multipv_count
+
+    def engine_options(self):
+        return strength_options(self.elo)
+
+
+class SettingsWatcher:
+    """Reloads the config file whenever it changes and swaps in a new Settings snapshot.
+    A config which fails to parse or validate is logged and the previous snapshot kept."""
+
+    def __init__(self, path, settings, interval=1.0):
+        self.path = path
+        self.settings = settings  # replaced whole, so readers on other threads always see one version
+        self.interval = interval
+        self.mtime = self.modified_time()
+        self.reloads = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def modified_time(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            mtime = self.modified_time()
+            if mtime is None or mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            self.reload()
+
+    def reload(self):
+        config = ConfigParser()
+        try:
+            config.read(self.path)
+            settings = Settings.from_config(config)
+        except Exception as e:
+            self.errors += 1
+            logger.error('Ignoring changes to %s: %s', self.path, e)
+            return
+        if settings != self.settings:
+            logger.info('Reloaded settings from %s', self.path)
+            self.reloads += 1
+            self.settings = settings
+
+    def stats(self):
+        return {'reloads': self.reloads, 'errors': self.errors}
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
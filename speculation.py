@@ -0,0 +1,126 @@
+import logging
+
+import chess.polyglot
+
+logger = logging.getLogger(__name__)
+
+# queued behind searches for the position actually on the board
+SPECULATION_PRIORITY = 1
+
+
+class Speculation:
+    def __init__(self, future, path_keys):
+        self.future = future
+        # positions the game has to pass through to reach this one, including the one speculated from
+        self.path_keys = path_keys
+
+
+class Speculator:
+    def __init__(self, pool, cache, limit, depth, multipv, engine_name=None, replies=2):
+        self.pool = pool
+        self.cache = cache
+        self.limit = limit
+        self.depth = depth
+        self.multipv = multipv
+        self.engine_name = engine_name  # the pool's results are cached under this name
+        self.replies = replies
+
+        self.speculations = {}  # zobrist hash -> Speculation
+
+        self.submitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.useful_time = 0.0
+        self.wasted_time = 0.0
+        self.abandoned = []  # futures of speculations the game never reached, until their engine has stopped
+
+    def speculate(self, board, infos):
+        """Pre-analyse the positions after our top moves and the opponent's predicted replies"""
+        root_key = chess.polyglot.zobrist_hash(board)
+        for info in infos[:self.replies]:
+            pv = info.get('pv', [])
+            position = board.copy(stack=False)
+            path_keys = [root_key]
+            for move in pv[:2]:
+                position.push(move)
+                key = chess.polyglot.zobrist_hash(position)
+                self.submit(position, key, list(path_keys))
+                path_keys.append(key)
+
+    def submit(self, board, key, path_keys):
+        if key in self.speculations or self.cache.get(key, self.depth, self.multipv, self.engine_name) is not None:
+            return
+        if board.is_game_over():
+            return
+        future = self.pool.submit(board, self.limit, multipv=self.multipv, priority=SPECULATION_PRIORITY)
+        self.speculations[key] = Speculation(future, path_keys)
+        self.submitted += 1
+
+    def collect(self):
+        """Move finished speculative searches into the position cache"""
+        still_running = []
+        for future in self.abandoned:
+            if future.search_finished:
+                self.wasted_time += future.search_time
+            else:
+                still_running.append(future)
+        self.abandoned = still_running
+
+        for key, speculation in self.speculations.items():
+            self.store(key, speculation.future)
+
+    def store(self, key, future):
+        if future.done() and not future.cancelled() and future.exception() is None and \
+                not getattr(future, 'collected', False):
+            infos = future.result()
+            if not isinstance(infos, list):
+                infos = [infos]
+            self.cache.put(key, infos, self.depth, self.multipv, self.engine_name)
+            future.collected = True
+
+    def take(self, key):
+        """Hand over a speculation for the position now on the board.
+        Returns its future if the search is still running, so the caller can wait on it instead of searching again."""
+        speculation = self.speculations.pop(key, None)
+        if speculation is None:
+            return None
+        self.hits += 1
+        # finished since the last collect, so the caller will find it in the cache
+        self.store(key, speculation.future)
+        # the search may still be running, so its time is only known once it finishes
+        speculation.future.add_done_callback(self.taken_finished)
+        return None if speculation.future.done() else speculation.future
+
+    def taken_finished(self, future):
+        # a search that failed or was cancelled after all was of no use
+        if not future.cancelled() and future.exception() is None:
+            self.useful_time += future.search_time
+
+    def on_position(self, key):
+        """Cancel speculation that the game can no longer reach from the position with this key"""
+        self.collect()
+        for speculated_key in list(self.speculations):
+            speculation = self.speculations[speculated_key]
+            if speculated_key == key or key in speculation.path_keys:
+                continue  # the game is still on the predicted line
+            self.abandon(speculation)
+            del self.speculations[speculated_key]
+
+    def abandon(self, speculation):
+        speculation.future.cancel()
+        self.abandoned.append(speculation.future)
+        self.misses += 1
+
+    def cancel(self):
+        for speculation in self.speculations.values():
+            self.abandon(speculation)
+        self.speculations.clear()
+
+    def stats(self):
+        resolved = self.hits + self.misses
+        return {'submitted': self.submitted,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / resolved if resolved > 0 else 0.0,
+                'useful_seconds': self.useful_time,
+                'wasted_seconds': self.wasted_time}
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+
+import chess.polyglot
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingAnalysis:
+    def __init__(self, engine, multipv=1, update_depth=1, update_interval=0.25, initial_backoff=1, max_backoff=60):
+        self.engine = engine
+        self.multipv = multipv
+        self.update_depth = update_depth
+        self.update_interval = update_interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.analysis = None
+        self.thread = None
+        self.key = None
+
+        # latest complete set of lines for the position being analysed
+        self.infos = None
+        self.depth = 0
+        self.generation = 0
+        self.polled_generation = 0
+
+        # exception that ended the last search, reported to the engine from the polling thread
+        self.error = None
+        self.failures = 0
+        self.backoff = initial_backoff
+        self.next_start_time = 0
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def analyse(self, board):
+        """Keep analysing board in the background, restarting the search only when the position changes"""
+        key = chess.polyglot.zobrist_hash(board)
+        if key == self.key and self.is_running():
+            return False
+        if self.error is not None:
+            error, self.error = self.error, None
+            self.failures += 1
+            self.engine.analysis_failed(error)
+            self.next_start_time = time.monotonic() + self.backoff
+            logger.warning('Restarting streaming analysis in %s seconds', self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        if time.monotonic() < self.next_start_time:
+            return False
+
+        self.stop()
+        expected_lines = min(self.multipv, board.legal_moves.count())
+        with self.lock:
+            self.key = key
+            self.infos = None
+            self.depth = 0
+        self.analysis = self.engine.analysis(board, multipv=self.multipv)
+        self.thread = threading.Thread(target=self.run, args=(self.analysis, key, expected_lines), daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self, analysis, key, expected_lines):
+        lines = {}
+        published_depth = 0
+        published_time = 0
+        try:
+            for info in analysis:
+                if 'pv' not in info or 'score' not in info:
+                    continue  # e.g. currmove updates
+                line = info.get('multipv', 1)
+                lines[line] = info
+                if line != expected_lines or len(lines) < expected_lines:
+                    continue  # only publish complete iterations so every line has the same depth
+
+                depth = info.get('depth', 0)
+                now = time.monotonic()
+                if depth - published_depth >= self.update_depth or now - published_time >= self.update_interval:
+                    self.publish(key, [lines[i] for i in range(1, expected_lines + 1)], depth)
+                    published_depth = depth
+                    published_time = now
+        except Exception as e:
+            logger.error('Exception in streaming analysis: %s', e)
+            if analysis is self.analysis:
+                self.error = e  # a search stopped for a new position does not count
+
+    def publish(self, key, infos, depth):
+        with self.lock:
+            if key != self.key:
+                return  # the search was for a position that is no longer on the board
+            self.infos = infos
+            self.depth = depth
+            self.generation += 1
+        self.backoff = self.initial_backoff
+
+    def poll(self):
+        """Return the latest lines and their depth if they changed since the last poll, otherwise None"""
+        with self.lock:
+            if self.generation == self.polled_generation or self.infos is None:
+                return None
+            self.polled_generation = self.generation
+            return self.infos, self.depth
+
+    def stop(self):
+        if self.analysis is not None:
+            try:
+                self.analysis.stop()
+            except Exception as e:
+                logger.warning('Exception stopping streaming analysis: %s', e)
+            self.analysis = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.key = None
@@ -0,0 +1,101 @@
+import logging
+from collections import OrderedDict
+
+import chess
+import chess.engine
+import chess.syzygy
+
+logger = logging.getLogger(__name__)
+
+# centipawn score shown for a tablebase win, less the distance to the next zeroing move so faster wins rank higher
+TABLEBASE_WIN_SCORE = 20000
+
+
+class Tablebase:
+    def __init__(self, directory, max_pieces=6, cache_size=10000):
+        self.tablebase = chess.syzygy.open_tablebase(directory)
+        self.max_pieces = max_pieces
+        self.cache_size = cache_size
+        # zobrist hash -> [(move, wdl, dtz)] for every legal move, best first, from the side to move's point of view
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['tablebase']['directory'],
+                   max_pieces=config['tablebase'].getint('max_pieces'),
+                   cache_size=config['tablebase'].getint('cache_size'))
+
+    def covers(self, board):
+        return chess.popcount(board.occupied) <= self.max_pieces and not board.castling_rights
+
+    def rank_moves(self, board):
+        ranked = []
+        for move in board.legal_moves:
+            zeroing = board.is_zeroing(move)
+            board.push(move)
+            try:
+                checkmate = board.is_checkmate()
+                # the opponent's result after the move, so negated for ours
+                wdl = -self.tablebase.probe_wdl(board)
+                dtz = -self.tablebase.probe_dtz(board)
+            finally:
+                board.pop()
+            ranked.append((move, wdl, dtz, zeroing, checkmate))
+
+        def strength(item):
+            _, wdl, dtz, zeroing, checkmate = item
+            if wdl > 0:
+                # mate at once, otherwise win as fast as possible, preferring moves which reset the fifty move counter
+                return -wdl, not checkmate, not zeroing, abs(dtz)
+            # otherwise hold out for as long as possible
+            return -wdl, -abs(dtz)
+
+        return [(move, wdl, dtz) for move, wdl, dtz, _, _ in sorted(ranked, key=strength)]
+
+    def probe(self, board, key, multipv=1):
+        """Return the best moves for board from the tablebase shaped like engine InfoDicts,
+        or None if the position has too many pieces or a table is missing. key is the zobrist hash of board."""
+        if not self.covers(board):
+            return None
+
+        ranked = self.cache.get(key)
+        if ranked is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        else:
+            self.misses += 1
+            try:
+                self.probes += 1
+                ranked = self.rank_moves(board)
+            except KeyError as e:
+                logger.debug('Missing tablebase: %s', e)
+                return None
+            self.cache[key] = ranked
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        if not ranked:
+            return None  # checkmate or stalemate; there is no move to show
+        return [{'pv': [move],
+                 'score': chess.engine.PovScore(Tablebase.score(wdl, dtz), board.turn),
+                 'depth': 0,
+                 'multipv': i + 1,
+                 'tbhits': 1} for i, (move, wdl, dtz) in enumerate(ranked[:multipv])]
+
+    @staticmethod
+    def score(wdl, dtz):
+        # cursed wins and blessed losses are draws under the fifty move rule
+        if wdl == 2:
+            return chess.engine.Cp(TABLEBASE_WIN_SCORE - abs(dtz))
+        if wdl == -2:
+            return chess.engine.Cp(-TABLEBASE_WIN_SCORE + abs(dtz))
+        return chess.engine.Cp(0)
+
+    def stats(self):
+        return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses, 'probes': self.probes}
+
+    def close(self):
+        self.tablebase.close()